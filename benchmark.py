@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+# Benchmark of the exercise importer against a local stand-in for a PTFLOW server
+#
+# For each scale (number of exercises):
+#   - generate a synthetic PNG pack with a start and end image per exercise
+#   - start a stand-in server for /api/1/images and /api/1/exercises with the
+#     configured latency distribution, error rates and payload limit
+#   - run exercise-importer.py end to end, using generated sheet rows (--stub-rows)
+#   - report exercises/sec, request latencies and the importer's peak RSS as JSON
+#
+# Example:
+#   python3 benchmark.py --scales 100,1000 --latency-ms 200 -- --workers 16
+
+from __future__ import print_function
+import argparse
+import collections
+import json
+import math
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+IMPORTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "exercise-importer.py")
+
+argparser = argparse.ArgumentParser(
+        description="Benchmark exercise-importer.py against a local stand-in server. "
+        + "Arguments after '--' are passed on to the importer")
+argparser.add_argument(
+        "--scales", type=str, default="100,1000,10000",
+        help="Comma separated numbers of exercises to import (default: 100,1000,10000)")
+argparser.add_argument(
+        "--latency-ms", type=float, default=50,
+        help="Mean server latency per request in milliseconds (default: 50)")
+argparser.add_argument(
+        "--latency-distribution", choices=["fixed", "uniform", "exponential", "lognormal"], default="lognormal",
+        help="Distribution of the server latency around the mean (default: lognormal)")
+argparser.add_argument(
+        "--error-rate", type=float, default=0.0,
+        help="Fraction of requests answered with 500 (default: 0)")
+argparser.add_argument(
+        "--throttle-rate", type=float, default=0.0,
+        help="Fraction of requests answered with 429 and a Retry-After header (default: 0)")
+argparser.add_argument(
+        "--retry-after", type=float, default=1.0,
+        help="Retry-After seconds sent with 429 responses (default: 1)")
+argparser.add_argument(
+        "--max-payload", type=int, default=10*1024*1024,
+        help="Requests with larger bodies are answered with 413 (default: 10 MiB)")
+argparser.add_argument(
+        "--image-size", type=int, default=256,
+        help="Width and height of the generated images in pixels (default: 256)")
+argparser.add_argument(
+        "--output", type=str,
+        help="Write the results to this file instead of stdout")
+argparser.add_argument(
+        "--keep", action="store_true",
+        help="Keep the generated files and importer output instead of deleting them")
+
+def main():
+    args = sys.argv[1:]
+    importer_args = []
+    if "--" in args:
+        importer_args = args[args.index("--") + 1:]
+        args = args[:args.index("--")]
+    parsed = argparser.parse_args(args)
+
+    results = {
+            'settings': {
+                'latency_ms': parsed.latency_ms,
+                'latency_distribution': parsed.latency_distribution,
+                'error_rate': parsed.error_rate,
+                'throttle_rate': parsed.throttle_rate,
+                'max_payload': parsed.max_payload,
+                'image_size': parsed.image_size,
+                'importer_args': importer_args },
+            'runs': [] }
+
+    for scale in [int(s) for s in parsed.scales.split(",")]:
+        results['runs'].append(run_benchmark(scale, parsed, importer_args))
+
+    output = json.dumps(results, indent=2)
+    if parsed.output:
+        with open(parsed.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+def run_benchmark(scale, parsed, importer_args):
+    work_dir = tempfile.mkdtemp(prefix="ptflow-bench-%d-"%scale)
+    image_dir = os.path.join(work_dir, "PACK") + "/"
+    create_image_pack(image_dir, scale, parsed.image_size)
+
+    server = StandInServer(
+            latency = LatencyDistribution(parsed.latency_distribution, parsed.latency_ms / 1000.0),
+            error_rate = parsed.error_rate,
+            throttle_rate = parsed.throttle_rate,
+            retry_after = parsed.retry_after,
+            max_payload = parsed.max_payload)
+    server.start()
+
+    command = [sys.executable, IMPORTER,
+            "--stub-rows", str(scale),
+            "--image-dir", image_dir,
+            "--bookkeeping-id", "benchmark",
+            "--server", server.url,
+            "--session-token", "benchmark"] + importer_args
+
+    try:
+        with open(os.path.join(work_dir, "output.txt"), "w") as output:
+            start = time.monotonic()
+            process = subprocess.Popen(command, cwd=work_dir, stdout=output, stderr=subprocess.STDOUT)
+            _, status, rusage = os.wait4(process.pid, 0)
+            elapsed = time.monotonic() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        server.stop()
+        if not parsed.keep:
+            shutil.rmtree(work_dir)
+
+    created = server.counts[("POST", "/api/1/exercises", 201)]
+    return {
+            'exercises': scale,
+            'exit_code': process.returncode,
+            'seconds': round(elapsed, 3),
+            'exercises_created': created,
+            'exercises_per_second': round(created / elapsed, 2),
+            'requests': sum(server.counts.values()),
+            'responses': {"%s %s %s"%key: count for key, count in sorted(server.counts.items())},
+            'latency_ms': {
+                'p50': round(server.percentile(50) * 1000, 2),
+                'p99': round(server.percentile(99) * 1000, 2) },
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': round(rusage.ru_maxrss / 1024.0, 1),
+            'work_dir': work_dir if parsed.keep else None }
+
+def create_image_pack(image_dir, scale, size):
+    """Create a start and end image for each of the generated sheet rows
+
+    Each image has some random pixels, so every image has different contents.
+    """
+    os.makedirs(image_dir)
+    for n in range(scale):
+        for suffix in ["a", "b"]:
+            with open(os.path.join(image_dir, "%04d-exercise-%s.png"%(n, suffix)), "wb") as file:
+                file.write(create_png(size, size))
+
+def create_png(width, height):
+    """A grayscale PNG with a random row of pixels on a white background"""
+    noise = os.urandom(width)
+    rows = [b"\x00" + noise] + [b"\x00" + b"\xff"*width for _ in range(height - 1)]
+    random.shuffle(rows)
+
+    def chunk(chunk_type, body):
+        return struct.pack(">I", len(body)) + chunk_type + body + struct.pack(">I", zlib.crc32(chunk_type + body))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(b"".join(rows)))
+            + chunk(b"IEND", b""))
+
+class LatencyDistribution:
+
+    def __init__(self, kind, mean):
+        self.kind = kind
+        self.mean = mean
+
+    def sample(self):
+        if self.mean <= 0:
+            return 0.0
+        if self.kind == "fixed":
+            return self.mean
+        if self.kind == "uniform":
+            return random.uniform(0, 2*self.mean)
+        if self.kind == "exponential":
+            return random.expovariate(1.0 / self.mean)
+        # lognormal with the given mean and a long tail
+        sigma = 0.75
+        return random.lognormvariate(0, sigma) * self.mean / math.exp(sigma**2 / 2)
+
+class StandInServer:
+    """Local stand-in for the parts of the PTFLOW API used by the importer
+
+    Runs in a background thread, counting responses by method, path and status
+    and recording the time taken to handle each request.
+    """
+
+    def __init__(self, latency, error_rate = 0.0, throttle_rate = 0.0, retry_after = 1.0, max_payload = 10*1024*1024):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.max_payload = max_payload
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.durations = []
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.create_handler())
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def record(self, method, path, status, duration):
+        with self.lock:
+            self.counts[(method, path, status)] += 1
+            self.durations.append(duration)
+
+    def percentile(self, percent):
+        with self.lock:
+            durations = sorted(self.durations)
+        if not durations:
+            return 0.0
+        return durations[min(len(durations) - 1, int(len(durations) * percent / 100.0))]
+
+    def respond(self, method, path, body_length):
+        """Decide on the status and body of a response"""
+        if body_length > self.max_payload:
+            return 413, {'error': 'Payload too large'}
+        draw = random.random()
+        if draw < self.throttle_rate:
+            return 429, {'error': 'Too many requests'}
+        if draw < self.throttle_rate + self.error_rate:
+            return 500, {'error': 'Internal server error'}
+
+        if method == "POST" and path == "/api/1/images":
+            return 201, {'image': {'id': str(uuid.uuid4())}}
+        if method == "POST" and path == "/api/1/exercises":
+            return 201, {'exercise': {'id': str(uuid.uuid4())}}
+        if method == "PUT" and path.startswith("/api/1/exercises/"):
+            return 200, {'exercise': {'id': path.rsplit("/", 1)[1]}}
+        if method in ("GET", "DELETE") and path.startswith(("/api/1/images/", "/api/1/exercises/")):
+            return 200, {}
+        return 404, {'error': 'Not found'}
+
+    def create_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately; without this every
+            # response waits for the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def handle_request(self):
+                start = time.monotonic()
+                body_length = int(self.headers.get("Content-Length", 0))
+                if body_length <= server.max_payload:
+                    self.rfile.read(body_length)
+                else:
+                    self.close_connection = True
+
+                time.sleep(server.latency.sample())
+                path = self.path.split("?")[0]
+                status, response = server.respond(self.command, path, body_length)
+
+                body = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if status == 429:
+                    self.send_header("Retry-After", str(server.retry_after))
+                self.end_headers()
+                self.wfile.write(body)
+
+                # count with the path template, not the individual uuids
+                template = "/".join(path.split("/")[:4]) + ("/{id}" if path.count("/") > 3 else "")
+                server.record(self.command, template, status, time.monotonic() - start)
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+        return Handler
+
+if __name__ == "__main__":
+    main()
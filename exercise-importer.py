@@ -8,7 +8,8 @@
 #
 # MAIN ALGO
 # support resuming session by filtering out already processed ids and continuing
-# does not support unfinished data uploads (meaning aborting program while uploading images or json)
+# unfinished data uploads (meaning aborting program while uploading images or json) continue
+# from the last step that was journaled, see UploadProgress
 #
 # get exercise data from google sheet
 # get previous result data, if any, to continue a previous session
@@ -28,21 +29,48 @@
 
 from __future__ import print_function
 import requests
+import requests.adapters
+import urllib3.exceptions
 import datetime
+import email.utils
+import fcntl
+import random
 import uuid
 import time
 import pickle
-import glob
+import queue
+import re
+import bisect
+import hashlib
+import io
 import logging
 import os
+import sqlite3
 import sys
+import threading
 import argparse
-import yaml
-
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.auth.exceptions import RefreshError
+import asyncio
+import collections
+import contextlib
+import json
+import multiprocessing
+import struct
+import subprocess
+import zlib
+import zipfile
+import shutil
+import tempfile
+import gzip
+import copy
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Slow to import, and not needed by every run, so these are imported where used:
+#   - googleapiclient, google_auth_oauthlib and google.auth, to read the sheet
+#   - aiohttp, for --async, see import_aiohttp
+#   - PIL, for --max-image-dimension
+#   - yaml, to migrate old bookkeeping files
+aiohttp = None
 
 # for heavy http logging
 # import http.client as http_client
@@ -55,12 +83,14 @@ RANGE_NAME = "ILLUSTRATIONS!B2:J"
 # For development using mock data
 use_fakes = False
 
-log_filename = "import.log"
-logging.basicConfig(
-        filename=log_filename, filemode="w", 
-        level=logging.DEBUG,
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S')
+log_filename = os.environ.get("PTFLOW_IMPORTER_LOG_FILE", "import.log")
+# the processes of a process pool import this file as __mp_main__, and must not truncate the log file
+if __name__ != "__mp_main__":
+    logging.basicConfig(
+            filename=log_filename, filemode="w", 
+            level=logging.DEBUG,
+            format='%(asctime)s %(levelname)-8s %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger("ptflow")
 
 formatter = logging.Formatter('[%(asctime)s]    %(message)s')
@@ -75,112 +105,563 @@ requests_log = logging.getLogger("requests.packages.urllib3")
 requests_log.setLevel(logging.DEBUG)
 requests_log.propagate = True
 
+def parse_priorities(value):
+    """Parse the comma separated priorities of --priorities"""
+    try:
+        return [int(priority) for priority in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not a comma separated list of priorities, i.e. 1,2" % value)
+
+def parse_shard(value):
+    """Parse the i/N of --shard into (i, N)"""
+    try:
+        index, count = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not of the form i/N, i.e. 1/4" % value)
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard %d does not exist, there are %d shards" % (index, count))
+    return index, count
+
 argparser = argparse.ArgumentParser()
 argparser.add_argument(
-        "--image-dir", type=str, required=True,
-        help="A directory containing image files that are named using a specific naming scheme: {id}-.*.png")
+        "command", nargs="?", default="import", choices=["import", "plan", "compact", "failures", "cleanup", "merge"],
+        help="'import' (the default) uploads exercises. "
+        + "'plan' works out what an import would do, reporting all problems at once, and saves the plan to run with --plan. "
+        + "'compact' rewrites the bookkeeping file, keeping only the latest entry for each exercise. "
+        + "'failures' lists the failed, skipped and interrupted exercises with the reason. "
+        + "'cleanup' deletes the exercises of unfinished uploads from the server, so they are created anew by the next import. "
+        + "'merge' combines the bookkeeping data of the shards of an import (see --shard) and prints the summary")
+argparser.add_argument(
+        "--image-dir", type=str,
+        help="A directory containing image files that are named using a specific naming scheme: {id}-.*.png. "
+        + "Can also be the zip file exported from Google Drive, which is read without unpacking it")
 argparser.add_argument(
         "--sheets-id", type=str, 
         help="The id of the Google Sheet containing exercise data (i.e. '18_LuqnjAmVzAL6zQzJKjSWqGgPMLgYx0I_k3wV2I2xg'")
 argparser.add_argument(
-        "--bookkeeping-id", type=str, required=True,
-        help="Used to keep tabs on what data has been uploaded. Makes it possible to resume a previous upload, avoiding duplicated uploads")
+        "--bookkeeping-id", type=str, required=True, action="append",
+        help="Used to keep tabs on what data has been uploaded. Makes it possible to resume a previous upload, avoiding duplicated uploads. "
+        + "Give one for each --server")
+argparser.add_argument(
+        "--bookkeeping-backend", choices=["journal", "sqlite"], default="journal",
+        help="Where to keep the bookkeeping data: a journal file per bookkeeping id (the default), "
+        + "or a single SQLite database (data/bookkeeping.sqlite) shared by all bookkeeping ids and servers")
+argparser.add_argument(
+        "--optimize-images", action="store_true",
+        help="Losslessly recompress the images before uploading them")
+argparser.add_argument(
+        "--max-image-dimension", type=int,
+        help="Downscale images so neither width nor height exceeds this many pixels before uploading them. Requires Pillow")
+argparser.add_argument(
+        "--preprocess-workers", type=int,
+        help="Number of processes used for optimizing and downscaling images (default: number of CPUs)")
+argparser.add_argument(
+        "--stub-rows", type=int,
+        help="For testing and benchmarking: use this many generated rows instead of the Google Sheet")
+argparser.add_argument(
+        "--priorities", type=parse_priorities, default="1,2",
+        help="Comma separated priorities (the first column of the sheet) of the exercises to import, "
+        + "most important first (default: 1,2)")
+argparser.add_argument(
+        "--schedule", choices=["sheet", "priority"], default="sheet",
+        help="'sheet' (the default) uploads the exercises in sheet order. 'priority' uploads them in the order of --priorities, "
+        + "and within a priority the exercises with the most image bytes first, so the workers stay busy until the end")
+argparser.add_argument(
+        "--deadline", type=float,
+        help="Stop starting new uploads after this many minutes. With --schedule priority, this uploads "
+        + "as many of the most important exercises as time allows. The rest are left for the next run")
 argparser.add_argument(
-        "--session-token", type=str, 
+        "--sheet-snapshot", type=str,
+        help="Read the rows from this snapshot of the sheet instead of the Google Sheet. "
+        + "If it does not exist yet, the sheet is read and saved to it. Delete it to read the sheet again")
+argparser.add_argument(
+        "--page-size", type=int, default=500,
+        help="Number of rows to fetch from the sheet per request. Uploading starts after the first page (default: 500)")
+argparser.add_argument(
+        "--sync", action="store_true",
+        help="Also update exercises uploaded in a previous session if their row in the sheet has changed since")
+argparser.add_argument(
+        "--retry-failed", action="store_true",
+        help="Only upload the exercises that failed or were interrupted in a previous session")
+argparser.add_argument(
+        "--reconcile", action="store_true",
+        help="Look up the exercises already on the server and skip those, even if the bookkeeping data does not know about them "
+        + "(i.e. when importing from another machine). Nothing is written to the server for them")
+argparser.add_argument(
+        "--shard", type=parse_shard,
+        help="Only import the exercises of shard i of N (i.e. 2/4), partitioned by id. "
+        + "The shard has its own bookkeeping data, {bookkeeping-id}-shard-i-of-N, to combine with the 'merge' command")
+argparser.add_argument(
+        "--shards", type=int,
+        help="Run the import as this many shard processes on this machine, showing their combined progress, "
+        + "and merge their bookkeeping data when done. With the 'merge' command: the number of shards to merge")
+argparser.add_argument(
+        "--plan", type=str,
+        help="Import by running a plan saved by the 'plan' command, without reading the sheet or the image dir again. "
+        + "With the 'plan' command: where to save the plan (default: data/{bookkeeping-id}-plan.json)")
+argparser.add_argument(
+        "--upload-mode", choices=["images-first", "create-then-update"], default="images-first",
+        help="'images-first' (the default) uploads the images, then creates the exercise with the image ids in one request. "
+        + "'create-then-update' creates the exercise, uploads the images and then updates the exercise, for servers that need it")
+argparser.add_argument(
+        "--session-token", type=str, action="append",
         help="A valid session token taken from a browser to use when " 
         + "performing REST calls to the PTFLOW server. "
-        + "Can also be set using the environment variable PTFLOW_TOKEN.")
+        + "Can also be set using the environment variable PTFLOW_TOKEN. Give one for each --server, or one for all")
 argparser.add_argument(
-        "--server", type=str, 
+        "--server", type=str, action="append",
         help="The server url, including an optional port number (i.e. https://myserver.dev:443). "
-        + "Can also be set using the environment variable PTFLOW_SERVER.")
+        + "Can also be set using the environment variable PTFLOW_SERVER. "
+        + "Repeat to import into several servers at once, each with its own --session-token and --bookkeeping-id")
+argparser.add_argument(
+        "--workers", type=int, default=1,
+        help="Number of exercises to upload concurrently (default: 1). "
+        + "When above 1, the start and end images of an exercise are also uploaded in parallel.")
+argparser.add_argument(
+        "--pool-size", type=int,
+        help="Maximum number of pooled connections to keep open to the server (default: twice the number of workers, at least 10)")
+argparser.add_argument(
+        "--no-keep-alive", action="store_true",
+        help="Close the connection after each request instead of reusing it")
+argparser.add_argument(
+        "--retries", type=int, default=3,
+        help="Number of times to retry a request that failed with a timeout, connection error, 429 or 5xx (default: 3)")
+argparser.add_argument(
+        "--backoff-factor", type=float, default=0.5,
+        help="Base delay in seconds for the exponential retry backoff (default: 0.5)")
+argparser.add_argument(
+        "--connect-timeout", type=float, default=3.05,
+        help="Seconds to wait for a connection to the server (default: 3.05)")
+argparser.add_argument(
+        "--read-timeout", type=float, default=5.0,
+        help="Seconds to wait for the server to respond (default: 5.0)")
+argparser.add_argument(
+        "--adaptive", action="store_true",
+        help="Adapt the number of concurrent requests to the server: grow it while responses are fast and successful, "
+        + "cut it on 429, 5xx, timeouts or rising latency. The maximum is twice --workers, or --max-in-flight with --async")
+argparser.add_argument(
+        "--max-rps", type=float,
+        help="Never send more than this many requests per second, i.e. for production servers shared with end users")
+argparser.add_argument(
+        "--async", dest="use_async", action="store_true",
+        help="Run all uploads on a single asyncio event loop instead of worker threads. Requires aiohttp")
+argparser.add_argument(
+        "--max-in-flight", type=int, default=100,
+        help="Maximum number of concurrent requests when using --async (default: 100)")
+argparser.add_argument(
+        "--rescan-images", action="store_true",
+        help="Ignore the cached index of the image directory and scan it again")
+argparser.add_argument(
+        "--no-image-cache", action="store_true",
+        help="Upload every image, even if the same image was uploaded to the server before")
+argparser.add_argument(
+        "--verify-cache", action="store_true",
+        help="Check that all cached image ids still exist on the server before uploading, and drop those that do not")
+argparser.add_argument(
+        "--image-cache-max-age", type=float, default=90,
+        help="Evict cached image ids not used for this many days (default: 90)")
+argparser.add_argument(
+        "--image-cache-max-entries", type=int, default=100000,
+        help="Maximum number of cached image ids, evicting the least recently used (default: 100000)")
+argparser.add_argument(
+        "--progress-interval", type=float, default=10,
+        help="Seconds between progress lines with the upload rate and estimated time left. 0 disables them (default: 10)")
 
 def main():
     parsed = argparser.parse_args()
-    try:
-        session_token = parsed.session_token or os.environ["PTFLOW_TOKEN"]
-        server = parsed.server or os.environ["PTFLOW_SERVER"]
-
-        logger.debug("Server URL: %s"%server)
-        logger.debug("Session token: %s"%session_token) 
-    except KeyError as e:
+    targets = create_targets(parsed)
+
+    if parsed.command == "compact":
+        for target in targets:
+            oplog = open_oplog(target.data_id, parsed.bookkeeping_backend)
+            oplog.compact()
+            oplog.close()
+        return
+
+    if parsed.command == "failures":
+        for target in targets:
+            if len(targets) > 1:
+                print("%s:" % target.data_id)
+            oplog = open_oplog(target.data_id, parsed.bookkeeping_backend)
+            print_failures(oplog)
+            oplog.close()
+        return
+
+    if parsed.command == "plan":
+        if not parsed.image_dir:
+            argparser.error("--image-dir is required when planning")
+        if len(targets) > 1:
+            argparser.error("plans are made for one --bookkeeping-id at a time")
+        make_plan(parsed)
+        return
+
+    if parsed.command == "merge":
+        if not parsed.shards:
+            argparser.error("--shards is required when merging")
+        for target in targets:
+            merge_shards(parsed, target.bookkeeping_id, target.server)
+        return
+
+    if not all(target.server and target.session_token for target in targets):
         print("Server and session token are required")
         sys.exit(1)
+    for target in targets:
+        logger.debug("Server URL: %s"%target.server)
+        logger.debug("Session token: %s"%target.session_token)
 
-    if use_fakes:
-        logger.info("Using fakes for data")
-        uploader = FakeUploader() # quick testing
-        get_exercise_rows = get_stubbed_rows
-    else:
-        uploader = RealUploader(server, session_token)
-        get_exercise_rows = get_spreadsheet_values
+    if parsed.command == "cleanup":
+        for target in targets:
+            oplog = open_oplog(target.data_id, parsed.bookkeeping_backend, target.server)
+            clean_up_orphans(oplog, create_uploader(parsed, target.server, target.session_token, use_async = False))
+            oplog.close()
+        return
 
-    image_dir = parsed.image_dir
-    sheets_id = parsed.sheets_id or SPREADSHEET_ID
+    if not parsed.image_dir and not parsed.plan:
+        argparser.error("--image-dir or --plan is required when importing")
 
-    values = get_exercise_rows(sheets_id, RANGE_NAME)
+    if parsed.plan and len(targets) > 1:
+        argparser.error("a plan is made for one --bookkeeping-id, so it can only be run against one server")
 
-    if not values:
-        logger.error("No data found in spreadsheet.")
+    if parsed.use_async and not use_fakes and not import_aiohttp():
+        print("The aiohttp package is required for --async")
         sys.exit(1)
-    
-    logger.info("Got %s exercise rows from Google Sheets", len(values))
 
-    # init bookkeeping file
-    if not os.path.isdir("data"):
-        os.mkdir("data")
-    oplog_filename = "data/%s-log.yml"%parsed.bookkeeping_id
+    if parsed.max_image_dimension and not is_installed("PIL"):
+        print("The Pillow package is required for --max-image-dimension")
+        sys.exit(1)
 
-    uploads = create_upload_map(oplog_filename)
-    if len(uploads.keys()):
-        logger.info("Continuing uploads from previous session (%s uploads so far) ...", len(uploads.keys()))
+    if parsed.shards and not parsed.shard:
+        failed = launch_shards(parsed)
+        for target in targets:
+            merge_shards(parsed, target.bookkeeping_id, target.server)
+        if failed:
+            # so scripts notice the shards that were not imported
+            print("Shards that exited with an error: %s" % ", ".join("%d/%d" % (index, parsed.shards) for index in failed))
+            sys.exit(1)
+        return
+
+    # all targets share the image upload cache file, the image preprocessing and,
+    # with more than one target, the image files read from disk
+    image_cache = None
+    if not parsed.no_image_cache:
+        image_cache = ImageUploadCache("data/image-cache.json", targets[0].server,
+                max_age_days = parsed.image_cache_max_age,
+                max_entries = parsed.image_cache_max_entries)
+
+    preprocessor = None
+    if parsed.optimize_images or parsed.max_image_dimension:
+        preprocessor = ImagePreprocessor(
+                create_process_pool(parsed.preprocess_workers),
+                optimize = parsed.optimize_images,
+                max_dimension = parsed.max_image_dimension)
+
+    image_reads = ImageReadCache(IMAGE_READ_CACHE_BYTES) if len(targets) > 1 else None
+
+    runs = [TargetRun(parsed, target, len(targets) > 1, image_cache, preprocessor, image_reads) for target in targets]
+
+    plan = None
+    if parsed.plan:
+        plan = load_plan(parsed.plan, parsed.bookkeeping_id)
+    else:
+        # pages are fetched in the background, while the first rows are being uploaded
+        pages = prefetch(count_rows(create_page_source(parsed)))
+        rows = (row for page in pages for row in page)
+
+    if plan:
+        image_index = PlannedImageIndex(plan)
+    else:
+        image_index = ImageIndex.load(parsed.image_dir, rescan = parsed.rescan_images)
 
     logger.debug("Starting to loop through values from spreadsheet")
-    prioritized=[1,2]
-    filtered = [row for row in values if int(row[0]) in prioritized]
-    logger.info("Skipping %d exercises that are not priority %s", len(values)-len(filtered), prioritized)
+    prioritized = parsed.priorities
+    priorities = {} if parsed.schedule == "priority" else None
+    images_first = parsed.upload_mode == "images-first"
+    sync = parsed.sync
+    if plan:
+        spreadsheet_ids = plan['sheet_ids']
+        sync = sync or plan['sync']
+        prioritized = plan['prioritized']
+        if parsed.shard:
+            spreadsheet_ids = [id for id in spreadsheet_ids if in_shard(id, parsed.shard)]
+        exercises = planned_exercises(plan, runs[0].uploads, runs[0].oplog, parsed.shard, priorities)
+    elif len(runs) == 1:
+        spreadsheet_ids = []
+        exercises = parse_exercises(rows, prioritized, runs[0].oplog, spreadsheet_ids, runs[0].only_ids, parsed.shard, priorities)
+    else:
+        spreadsheet_ids = []
+        exercises = parse_exercises(rows, prioritized, FanOutOplog([run.oplog for run in runs]), spreadsheet_ids, None, parsed.shard, priorities)
 
-    exercises = []
-    for row in filtered:
-        try:
-            exercise = Exercise.from_row(row[1:])
-            logger.debug(str(exercise))
-            exercises.append(exercise)
-        except InvalidExerciseData as e:
-            logger.warning("Invalid exercise data: {0}".format(e))
-            result = LoggedExercise.from_failure(row[0], Status.SKIPPED, str(e))
-            add_result_to_oplog(result, oplog_filename)
-            continue
+    if parsed.schedule == "priority":
+        exercises = schedule_by_priority(exercises, priorities, prioritized, image_index)
+    if len(runs) > 1:
+        # the rows are parsed once, the targets each go through them at their own pace
+        exercises = Broadcast(exercises, len(runs), BROADCAST_MAX_LAG)
 
-    for exercise in exercises:
-        try:
-            images = get_images(image_dir, exercise.id)
+    progress = None
+    if parsed.progress_interval > 0:
+        progress = ProgressReporter(metrics, parsed.progress_interval, "data/%s-metrics"%targets[0].data_id,
+                targets = [run.label for run in runs] if len(runs) > 1 else None)
+        progress.start()
+
+    try:
+        if len(runs) == 1:
+            try:
+                runs[0].run(exercises, image_index, sync, images_first)
+            except EmptySheetException as e:
+                logger.error(str(e))
+                sys.exit(1)
+        else:
+            threads = [threading.Thread(target = run.run_logged, args = (exercises, image_index, sync, images_first), daemon = True)
+                    for run in runs]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        if progress:
+            progress.stop()
+        for run in runs:
+            run.oplog.close()
+        if image_cache:
+            image_cache.save()
+        if preprocessor:
+            preprocessor.executor.shutdown()
+        metrics_files = []
+        for target in targets:
+            metrics_files += metrics.write("data/%s-metrics"%target.data_id)
 
-            # check if already uploaded - return early if so
-            if exercise.id in uploads and uploads[exercise.id].status == Status.OK:
-                logger.debug("Already uploaded exercise '%s' (server id: %s). Skipping.", exercise.id, uploads[exercise.id].uuid)
-                continue
+    print("\nFinished uploading!")
+    print(80*"-")
+    for run in runs:
+        if len(runs) > 1:
+            print("\n%s (%s):" % (run.target.server, run.target.data_id))
+            if run.error:
+                print("Stopped by an error: %s" % run.error)
+        failed_updates = None
+        if sync:
+            labels = { 'target': run.label } if run.label else {}
+            failed_updates = metrics.total("exercises_done_total", status = Status.FAILED, action = Action.UPDATE, **labels)
+        print_summary(run.oplog, spreadsheet_ids, failed_updates)
+    if preprocessor and preprocessor.bytes_before:
+        print("Image bytes before/after preprocessing: %d/%d (%+.1f%%)" % (
+            preprocessor.bytes_before, preprocessor.bytes_after,
+            100.0 * (preprocessor.bytes_after - preprocessor.bytes_before) / preprocessor.bytes_before))
+    print_request_metrics(metrics)
+    print("\nLogfile: %s" % log_filename)
+    print("Metrics: %s" % ", ".join(metrics_files))
+    print(80*"-")
 
-            result = upload_exercise(exercise, images, uploader)
-            add_result_to_oplog(result, oplog_filename)
+    if any(run.error for run in runs):
+        # so scripts notice the targets that were not imported into
+        sys.exit(1)
 
-        except NonConformingImagesException as exception:
-            logger.warning("Images do not conform to expectation: %s", exception)
-            result = LoggedExercise.from_failure(exercise.id, Status.SKIPPED, str(exception))
-            add_result_to_oplog(result, oplog_filename)
+class Target:
+    """A server to import into, with its session token and bookkeeping id"""
 
-        except requests.exceptions.RequestException as exception:
-            logger.warning("Upload failed: %s", exception)
-            result = LoggedExercise.from_failure(exercise.id, Status.FAILED, str(exception))
-            add_result_to_oplog(result, oplog_filename)
+    def __init__(self, server, session_token, bookkeeping_id, shard = None):
+        self.server = server
+        self.session_token = session_token
+        self.bookkeeping_id = bookkeeping_id
+        # the bookkeeping id this run reads and writes, see --shard
+        self.data_id = shard_bookkeeping_id(bookkeeping_id, shard) if shard else bookkeeping_id
+
+def create_targets(parsed):
+    """The targets given by the --server, --session-token and --bookkeeping-id options, paired in order
+
+    A single target can take its server and token from the environment, and
+    one token can be given for all servers. Afterwards parsed.server,
+    parsed.session_token and parsed.bookkeeping_id are those of the first
+    target, for the commands that work on a single one.
+    """
+    servers = parsed.server or [os.environ.get("PTFLOW_SERVER")]
+    tokens = parsed.session_token or [os.environ.get("PTFLOW_TOKEN")]
+    bookkeeping_ids = parsed.bookkeeping_id
+    if len(tokens) == 1:
+        tokens = tokens * len(servers)
+    if len(servers) == 1 and len(bookkeeping_ids) > 1:
+        servers = servers * len(bookkeeping_ids)
+        tokens = tokens * len(bookkeeping_ids)
+    if not len(servers) == len(tokens) == len(bookkeeping_ids):
+        argparser.error("give a --session-token (or one for all) and a --bookkeeping-id for each --server")
+    if len(set(bookkeeping_ids)) < len(bookkeeping_ids):
+        argparser.error("each --server needs its own --bookkeeping-id")
+
+    parsed.server, parsed.session_token, parsed.bookkeeping_id = servers[0], tokens[0], bookkeeping_ids[0]
+    return [Target(server, token, bookkeeping_id, parsed.shard)
+            for server, token, bookkeeping_id in zip(servers, tokens, bookkeeping_ids)]
+
+class TargetRun:
+    """The import into one target, with its own uploader and bookkeeping data
+
+    With more than one target, each is imported in its own thread, so a slow
+    or failing server does not hold up the others. Their exercises are then
+    counted with a target label.
+    """
 
+    def __init__(self, parsed, target, labelled = False, image_cache = None, preprocessor = None, image_reads = None):
+        self.parsed = parsed
+        self.target = target
+        self.label = target.data_id if labelled else None
+        self.error = None
+        self.uploader = create_uploader(parsed, target.server, target.session_token, parsed.use_async)
+
+        self.server_index = None
+        if parsed.reconcile:
+            # page through the server's exercises while the sheet and the images are read
+            executor = ThreadPoolExecutor(max_workers = 1)
+            self.server_index = executor.submit(fetch_server_index,
+                    create_uploader(parsed, target.server, target.session_token, use_async = False))
+            executor.shutdown(wait = False)
+
+        oplog = open_oplog(target.data_id, parsed.bookkeeping_backend, target.server)
+        self.uploads = create_upload_map(oplog)
+        self.oplog = SummarizedOplog(oplog, self.uploads)
+        if len(self.uploads.keys()):
+            logger.info("Continuing uploads from previous session of %s (%s uploads so far) ...", target.data_id, len(self.uploads.keys()))
+
+        self.only_ids = None
+        if parsed.retry_failed:
+            self.only_ids = create_upload_map(self.oplog, [Status.FAILED, Status.PENDING])
+            logger.info("Retrying %d exercises that failed or were interrupted in a previous session of %s", len(self.only_ids), target.data_id)
+
+        if image_cache:
+            image_cache = image_cache.for_server(target.server)
+            if parsed.verify_cache:
+                image_cache.verify(create_uploader(parsed, target.server, target.session_token, use_async = False), parsed.workers)
+            wrapper = AsyncCachingUploader if parsed.use_async else CachingUploader
+            self.uploader = wrapper(self.uploader, image_cache)
+
+        # preprocessing goes before the image cache, which then holds the processed images
+        if preprocessor:
+            wrapper = AsyncPreprocessingUploader if parsed.use_async else PreprocessingUploader
+            self.uploader = wrapper(self.uploader, preprocessor)
+
+        if image_reads:
+            wrapper = AsyncSharedReadsUploader if parsed.use_async else SharedReadsUploader
+            self.uploader = wrapper(self.uploader, image_reads)
+
+    def exercises(self, exercises):
+        """This target's share of the exercises from the sheet"""
+        if self.label:
+            # the exercises are shared with the other targets, and uploading changes them
+            exercises = (copy.copy(exercise) for exercise in exercises
+                    if self.only_ids is None or exercise.id in self.only_ids)
+        if self.server_index:
+            exercises = reconcile(exercises, self.server_index, self.uploads, self.oplog)
+        if self.parsed.deadline:
+            exercises = until_deadline(exercises, 60 * self.parsed.deadline)
+        return exercises
+
+    def run(self, exercises, image_index, sync = False, images_first = True):
+        parsed = self.parsed
+        exercises = self.exercises(exercises)
+        if parsed.use_async:
+            asyncio.run(run_async_uploads(exercises, image_index, self.uploads, self.uploader, self.oplog,
+                parsed.max_in_flight, sync, images_first, self.label))
+        else:
+            run_uploads(exercises, image_index, self.uploads, self.uploader, self.oplog,
+                    parsed.workers, sync, images_first, self.label)
 
+    def run_logged(self, exercises, *args):
+        """run, for a thread of its own, logging what stopped it"""
+        exercises = iter(exercises)
+        try:
+            self.run(exercises, *args)
+        except (Exception, SystemExit) as e:
+            self.error = str(e) or repr(e)
+            logger.exception("The import into %s (%s) stopped", self.target.server, self.target.data_id)
+        finally:
+            # the other targets' Broadcast consumers then no longer wait for this one
+            exercises.close()
+
+class Broadcast:
+    """Lets several consumers, each in a thread of its own, go through all the items of one iterator
+
+    Whichever consumer is ahead takes the next item from the iterator. The items
+    are kept until all consumers have passed them, so one that is behind does not
+    hold up the others, until it is max_lag items behind: those ahead then wait,
+    so a slow target does not keep the whole sheet in memory. A consumer stops
+    counting once it is closed, so each must be closed when done with. An error
+    raised by the iterator is raised in all the consumers that get to it.
+    """
 
-    summary = create_summary(oplog_filename, values)
+    def __init__(self, iterable, consumers, max_lag = None):
+        self.iterator = iter(iterable)
+        self.items = collections.deque()
+        self.first = 0 # position of items[0]
+        self.positions = dict() # of the current consumers
+        self.not_started = consumers
+        self.max_lag = max_lag
+        self.done = False
+        self.error = None # raised by the iterator
+        self.changed = threading.Condition()
+
+    def __iter__(self):
+        consumer = self.consume()
+        next(consumer) # registers the consumer, so it counts even if it is closed before taking an item
+        return consumer
+
+    def consume(self):
+        key = object()
+        with self.changed:
+            self.not_started -= 1
+            self.positions[key] = self.first
+        try:
+            yield
+            while True:
+                with self.changed:
+                    position = self.positions[key]
+                    while position == self.first + len(self.items):
+                        if self.done:
+                            return
+                        if self.max_lag and len(self.items) >= self.max_lag:
+                            self.changed.wait()
+                            continue
+                        if self.error:
+                            raise self.error
+                        try:
+                            self.items.append(next(self.iterator))
+                        except StopIteration:
+                            self.done = True
+                            return
+                        except Exception as e:
+                            # for the other consumers too
+                            self.error = e
+                            raise
+                    item = self.items[position - self.first]
+                    self.positions[key] = position + 1
+                    self.drop_passed()
+                yield item
+        finally:
+            with self.changed:
+                del self.positions[key]
+                self.drop_passed()
+
+    def drop_passed(self):
+        """Drop the items all consumers have passed, letting those waiting for that go on"""
+        if self.not_started:
+            return
+        passed = min(self.positions.values(), default = self.first + len(self.items))
+        if passed > self.first:
+            for _ in range(passed - self.first):
+                self.items.popleft()
+            self.first = passed
+            self.changed.notify_all()
+
+class FanOutOplog:
+    """Adds the same entries to the bookkeeping data of several targets, i.e. for invalid rows"""
+
+    def __init__(self, oplogs):
+        self.oplogs = oplogs
+
+    def append(self, item):
+        for oplog in self.oplogs:
+            oplog.append(item)
+
+def print_summary(oplog, spreadsheet_ids, failed_updates = None):
+    summary = create_summary(oplog, spreadsheet_ids)
     difference_ids = summary[3]
-    print("\nFinished uploading!")
-    print(80*"-")
-    print("Total number of exercises in Google Sheet: %d" % len(values))
+    print("Total number of exercises in Google Sheet: %d" % len(spreadsheet_ids))
     print("Total number of exercises processed: %d" % summary[0])
     num_dif = len(difference_ids)
     if num_dif > 0 and num_dif < 10:
@@ -189,30 +670,816 @@ def main():
         print("There are %d ids missing from one or the other!"%num_dif)
     print("Failed uploads: %d" % summary[1])
     print("Skipped uploads: %d" % summary[2])
-    print("\nLogfile: %s" % log_filename)
+    if failed_updates is not None:
+        print("Failed updates: %d" % failed_updates)
+
+def in_shard(exercise_id, shard):
+    """Whether an exercise belongs to shard (i, N). Every process and host agrees on this"""
+    index, count = shard
+    return zlib.crc32(exercise_id.encode("utf-8")) % count == index - 1
+
+def shard_bookkeeping_id(bookkeeping_id, shard):
+    return "%s-shard-%d-of-%d" % (bookkeeping_id, shard[0], shard[1])
+
+def launch_shards(parsed):
+    """Run the import in one process per shard, logging their combined progress until all are done
+
+    Each process gets the same arguments, plus its --shard, and logs to its own
+    log file. Its output goes to data/{bookkeeping-id}-shard-i-of-N-output.txt.
+    Returns the numbers of the shards that exited with an error.
+    """
+    if not os.path.isdir("data"):
+        os.mkdir("data")
+    arguments = strip_option(sys.argv[1:], "--shards")
+    processes = []
+    launched = time.time()
+    for index in range(1, parsed.shards + 1):
+        shard_id = shard_bookkeeping_id(parsed.bookkeeping_id, (index, parsed.shards))
+        environment = dict(os.environ, PTFLOW_IMPORTER_LOG_FILE = "import-%s.log" % shard_id)
+        with open("data/%s-output.txt" % shard_id, "w") as output:
+            processes.append(subprocess.Popen(
+                [sys.executable, sys.argv[0]] + arguments + ["--shard", "%d/%d" % (index, parsed.shards)],
+                stdout = output, stderr = subprocess.STDOUT, env = environment))
+    logger.info("Started %d shard processes", parsed.shards)
+
+    metrics_filenames = ["data/%s-metrics.json" % shard_bookkeeping_id(parsed.bookkeeping_id, (index, parsed.shards))
+            for index in range(1, parsed.shards + 1)]
+    next_report = launched + parsed.progress_interval
+    while any(process.poll() is None for process in processes):
+        time.sleep(0.5)
+        if parsed.progress_interval > 0 and time.time() >= next_report:
+            next_report += parsed.progress_interval
+            running = sum(process.poll() is None for process in processes)
+            logger.info(shard_progress_line(read_shard_metrics(metrics_filenames, launched), running, parsed.shards))
+
+    failed = []
+    for index, process in enumerate(processes, 1):
+        if process.returncode != 0:
+            logger.warning("Shard %d/%d exited with status %d, see data/%s-output.txt", index, parsed.shards,
+                    process.returncode, shard_bookkeeping_id(parsed.bookkeeping_id, (index, parsed.shards)))
+            failed.append(index)
+    return failed
+
+def strip_option(arguments, option):
+    """The command line arguments without an option and its value"""
+    stripped = []
+    skip = False
+    for argument in arguments:
+        if skip:
+            skip = False
+        elif argument == option:
+            skip = True
+        elif not argument.startswith(option + "="):
+            stripped.append(argument)
+    return stripped
+
+def read_shard_metrics(filenames, since):
+    """The metrics the shard processes wrote after since, see ProgressReporter"""
+    shard_metrics = []
+    for filename in filenames:
+        try:
+            if os.path.getmtime(filename) >= since:
+                with open(filename, "r") as file:
+                    shard_metrics.append(Metrics.from_dict(json.load(file)))
+        except (OSError, ValueError):
+            pass # not written yet
+    return shard_metrics
+
+def shard_progress_line(shard_metrics, running, shards):
+    """Progress of all shards, like ProgressReporter.line. The slowest shard decides the ETA"""
+    done = sum(m.total("exercises_done_total") for m in shard_metrics)
+    failed = sum(m.total("exercises_done_total", status = Status.FAILED) for m in shard_metrics)
+    skipped = sum(m.total("exercises_done_total", status = Status.SKIPPED) for m in shard_metrics)
+    rate = sum(m.total("exercises_done_total") / m.elapsed() for m in shard_metrics if m.elapsed() > 0)
+    requests_rate = sum(m.total("requests_total") / m.elapsed() for m in shard_metrics if m.elapsed() > 0)
+
+    eta = "unknown"
+    seconds_left = []
+    for m in shard_metrics:
+        rows = m.gauge("sheet_rows")
+        rows_done = m.total("exercises_done_total") + m.total("rows_ignored_total")
+        if rows is not None and rows_done > 0:
+            seconds_left.append(m.elapsed() * max(0, rows - rows_done) / rows_done)
+    if len(seconds_left) == shards:
+        eta = str(datetime.timedelta(seconds = int(max(seconds_left))))
+    return "Progress: %d/%d shards running, %d exercises done (%d failed, %d skipped), %.1f exercises/s, %.1f requests/s, ETA %s" % (
+            running, shards, done, failed, skipped, rate, requests_rate, eta)
+
+def merge_shards(parsed, bookkeeping_id, server = None):
+    """The 'merge' command: combine the bookkeeping data of the shards into that of the bookkeeping id
+
+    For each exercise, the latest entry of any shard is added, unless the
+    merged data has a later one already, so merging again after running more
+    shards is fine. Then the summary is printed for the whole sheet.
+    """
+    oplog = open_oplog(bookkeeping_id, parsed.bookkeeping_backend, server)
+    merged = create_upload_map(oplog)
+    added = 0
+    for index in range(1, parsed.shards + 1):
+        shard_id = shard_bookkeeping_id(bookkeeping_id, (index, parsed.shards))
+        shard_oplog = open_oplog(shard_id, parsed.bookkeeping_backend, server)
+        entries = create_upload_map(shard_oplog)
+        shard_oplog.close()
+        if not entries:
+            logger.warning("No bookkeeping data for %s", shard_id)
+        for entry in entries.values():
+            previous = merged.get(entry.exercise_id)
+            if previous is None or previous.cts < entry.cts:
+                merged[entry.exercise_id] = entry
+                oplog.append(entry)
+                added += 1
+    oplog.close()
+    logger.info("Merged %d entries from %d shards into %s", added, parsed.shards, bookkeeping_id)
+
+    spreadsheet_ids = [row[1] for page in create_page_source(parsed) for row in page]
+    print("\nMerged the bookkeeping data of %d shards into %s" % (parsed.shards, bookkeeping_id))
+    print(80*"-")
+    print_summary(oplog, spreadsheet_ids)
     print(80*"-")
 
+def make_plan(parsed):
+    """The 'plan' command: work out what an import would do, report it and save the plan"""
+    server = parsed.server or os.environ.get("PTFLOW_SERVER")
+    oplog = open_oplog(parsed.bookkeeping_id, parsed.bookkeeping_backend, server)
+    uploads = create_upload_map(oplog)
+    only_ids = create_upload_map(oplog, [Status.FAILED, Status.PENDING]) if parsed.retry_failed else None
+    oplog.close()
+
+    rows = (row for page in create_page_source(parsed) for row in page)
+    image_index = ImageIndex.load(parsed.image_dir, rescan = parsed.rescan_images)
+    plan = build_plan(rows, parsed.priorities, image_index, uploads, parsed.sync, only_ids, parsed.upload_mode == "images-first")
+    plan['bookkeeping_id'] = parsed.bookkeeping_id
+    plan['image_dir'] = parsed.image_dir
+    plan['estimate'] = estimate_duration(plan, parsed)
+
+    filename = parsed.plan or "data/%s-plan.json"%parsed.bookkeeping_id
+    save_plan(plan, filename)
+    print_plan(plan)
+    print("\nSaved the plan to %s. To run it:" % filename)
+    print("python3 exercise-importer.py --bookkeeping-id %s --plan %s" % (parsed.bookkeeping_id, filename))
+
+def build_plan(rows, prioritized, image_index, uploads, sync = False, only_ids = None, images_first = True):
+    """Join the sheet rows, the image index and the bookkeeping data into a plan
+
+    Does in one pass, and without touching the server, what an import finds
+    out exercise by exercise: which rows are invalid or lack conforming images,
+    which exercises were uploaded already and what has to be sent for the rest.
+    Returns the plan, with an entry for every exercise to create, update or skip,
+    in sheet order.
+    """
+    plan = {
+            'created': datetime.datetime.utcnow().isoformat(),
+            'prioritized': prioritized,
+            'sync': sync,
+            'sheet_ids': [],
+            'exercises': [],
+            'counts': collections.Counter(),
+            'requests': 0,
+            'bytes': 0 }
+    first_row = parse_range(RANGE_NAME)[2]
+
+    for row_number, row in enumerate(rows, first_row):
+        plan['sheet_ids'].append(row[1] if len(row) > 1 else '')
+        entry = { 'id': plan['sheet_ids'][-1], 'row_number': row_number, 'row': row }
+        try:
+            priority = int(row[0])
+        except (ValueError, IndexError):
+            plan['exercises'].append(dict(entry, action = Action.SKIP, errors = ["Invalid priority: %r" % (row[0] if row else '')]))
+            plan['counts']['skip'] += 1
+            continue
+        if priority not in prioritized:
+            plan['counts']['not prioritized'] += 1
+            continue
+        if only_ids is not None and entry['id'] not in only_ids:
+            plan['counts']['not retried'] += 1
+            continue
 
-def create_upload_map(oplog_filename):
-    uploads = dict()
+        errors = []
+        try:
+            exercise = Exercise.from_row(list(row[1:]))
+        except InvalidExerciseData as e:
+            exercise = None
+            errors.append(str(e))
 
-    if not os.path.isfile(oplog_filename):
-        return uploads
+        images = []
+        try:
+            images = image_index.get_images(entry['id'])
+        except NonConformingImagesException as e:
+            errors.append(str(e))
+
+        if errors:
+            plan['exercises'].append(dict(entry, action = Action.SKIP, errors = errors))
+            plan['counts']['skip'] += 1
+            continue
+
+        action = decide_action(exercise, uploads, sync)
+        if not action:
+            plan['counts']['already uploaded'] += 1
+            continue
+
+        requests_needed, image_bytes = planned_work(action, images, uploads.get(entry['id']), images_first)
+        plan['exercises'].append(dict(entry, action = action, images = images, requests = requests_needed, bytes = image_bytes))
+        plan['counts'][action.lower()] += 1
+        plan['requests'] += requests_needed
+        plan['bytes'] += image_bytes
+
+    return plan
+
+def planned_work(action, images, previous, images_first = True):
+    """Number of requests and image bytes needed to create or update an exercise
+
+    Takes into account what a previous session that did not finish already
+    uploaded, see UploadProgress. The image cache may save some more.
+    """
+    if action == Action.UPDATE:
+        if previous.image_uuids:
+            return 1, 0
+        return 1 + len(images), sum(image_size(image) for image in images)
+
+    uuid, image_uuids, step = None, {}, None
+    if previous and previous.status != Status.OK:
+        uuid = previous.uuid
+        if previous.images == images:
+            image_uuids, step = previous.image_uuids or {}, previous.step
+    if step == Step.LINKED:
+        return 0, 0
+
+    missing = [image for key, image in zip(['start', 'end'], images) if not image_uuids.get(key)]
+    exercise_requests = 1 if uuid or images_first else 2
+    return exercise_requests + len(missing), sum(image_size(image) for image in missing)
+
+def estimate_duration(plan, parsed):
+    """Estimate how long running the plan takes, in seconds
+
+    Uses the average request latency from the metrics of the last run with the
+    same bookkeeping id, or DEFAULT_REQUEST_SECONDS if there are none.
+    """
+    latency, source = DEFAULT_REQUEST_SECONDS, "assumed"
+    metrics_filename = "data/%s-metrics.json"%parsed.bookkeeping_id
+    if os.path.isfile(metrics_filename):
+        with open(metrics_filename, "r") as file:
+            requests_timed = [h for h in json.load(file)['histograms'] if h['name'] == "request_duration_seconds"]
+        count = sum(h['count'] for h in requests_timed)
+        if count:
+            latency, source = sum(h['sum'] for h in requests_timed) / count, "from the last run"
+
+    concurrency = parsed.max_in_flight if parsed.use_async else parsed.workers
+    seconds = plan['requests'] * latency / concurrency
+    if parsed.max_rps:
+        seconds = max(seconds, plan['requests'] / parsed.max_rps)
+    return { 'seconds': seconds, 'request_seconds': latency, 'source': source, 'concurrency': concurrency }
+
+# average request latency used by estimate_duration when no run has been measured
+DEFAULT_REQUEST_SECONDS = 0.25
+
+def print_plan(plan):
+    counts = plan['counts']
+    print("Plan for %d rows in the sheet:" % len(plan['sheet_ids']))
+    print("  create:           %d exercises" % counts['create'])
+    print("  update:           %d exercises" % counts['update'])
+    print("  skip (errors):    %d exercises" % counts['skip'])
+    print("  already uploaded: %d exercises" % counts['already uploaded'])
+    print("  not priority %s: %d rows" % (plan['prioritized'], counts['not prioritized']))
+    if counts['not retried']:
+        print("  not retried:      %d rows" % counts['not retried'])
+
+    skipped = [entry for entry in plan['exercises'] if entry['action'] == Action.SKIP]
+    if skipped:
+        print("\nErrors:")
+        for entry in skipped:
+            print("  row %d, id %s: %s" % (entry['row_number'], entry['id'] or '-', "; ".join(entry['errors'])))
+
+    estimate = plan['estimate']
+    print("\nRequests: %d, image bytes: %.1f MiB" % (plan['requests'], plan['bytes'] / (1024.0*1024)))
+    print("Estimated duration: %s (%.0f ms per request %s, %d at a time)" % (
+        datetime.timedelta(seconds = int(estimate['seconds'])),
+        1000 * estimate['request_seconds'], estimate['source'], estimate['concurrency']))
+
+def save_plan(plan, filename):
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as file:
+        json.dump(plan, file, indent = 1)
+    os.replace(tmp_filename, filename)
+
+def load_plan(filename, bookkeeping_id):
+    with open(filename, "r") as file:
+        plan = json.load(file)
+    if plan['bookkeeping_id'] != bookkeeping_id:
+        logger.warning("The plan %s was made for bookkeeping id %s, not %s", filename, plan['bookkeeping_id'], bookkeeping_id)
+    logger.info("Running the plan %s made %s: %d exercises", filename, plan['created'], len(plan['exercises']))
+    metrics.set("sheet_rows", len(plan['exercises']))
+    return plan
+
+def planned_exercises(plan, uploads, oplog, shard = None, priorities = None):
+    """The exercises of a plan, logging the skipped ones like parse_exercises does"""
+    for entry in plan['exercises']:
+        if shard and not in_shard(entry['id'], shard):
+            metrics.count("rows_ignored_total")
+            continue
+        if entry['action'] == Action.SKIP:
+            result = LoggedExercise.from_failure(entry['id'], Status.SKIPPED, "; ".join(entry['errors']), uploads.get(entry['id']))
+            count_result(result)
+            add_result_to_oplog(result, oplog)
+            continue
+        if priorities is not None:
+            priorities[entry['id']] = int(entry['row'][0])
+        yield Exercise.from_row(list(entry['row'][1:]))
+
+class PlannedImageIndex:
+    """Stands in for ImageIndex when running a plan, which has the images of each exercise"""
+
+    def __init__(self, plan):
+        self.images = {entry['id']: entry['images'] for entry in plan['exercises'] if entry['action'] != Action.SKIP}
+
+    def get_images(self, exercise_id):
+        return self.images[exercise_id]
+
+def create_page_source(parsed):
+    """The pages of sheet rows to import, from the Google Sheet, a snapshot of it or generated for testing"""
+    sheets_id = parsed.sheets_id or SPREADSHEET_ID
+    if parsed.sheet_snapshot and os.path.isfile(parsed.sheet_snapshot):
+        return read_sheet_snapshot(parsed.sheet_snapshot, sheets_id, RANGE_NAME, parsed.page_size)
+
+    if use_fakes or parsed.stub_rows:
+        logger.info("Using fakes for data")
+        if parsed.stub_rows:
+            metrics.set("sheet_rows", parsed.stub_rows)
+        pages = get_stubbed_pages(sheets_id, RANGE_NAME, parsed.page_size, count = parsed.stub_rows)
+    else:
+        pages = get_spreadsheet_pages(sheets_id, RANGE_NAME, parsed.page_size)
+
+    if parsed.sheet_snapshot:
+        return write_sheet_snapshot(pages, parsed.sheet_snapshot, sheets_id, RANGE_NAME)
+    return pages
+
+def write_sheet_snapshot(pages, filename, sheets_id, spreadsheet_range):
+    """Pass on the pages of the sheet, saving the rows to a snapshot file
+
+    A snapshot is a gzipped file with a header line describing the sheet, then
+    a JSON list per row. The file only appears once all pages have been read.
+    """
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with gzip.open(tmp_filename, "wt", encoding = "utf-8") as file:
+        header = { 'sheets_id': sheets_id, 'range': spreadsheet_range, 'fetched': datetime.datetime.utcnow().isoformat() }
+        file.write(json.dumps(header) + "\n")
+        for page in pages:
+            for row in page:
+                file.write(json.dumps(row, separators = (',', ':')) + "\n")
+            yield page
+    os.replace(tmp_filename, filename)
+    logger.info("Saved a snapshot of the sheet to %s", filename)
+
+def read_sheet_snapshot(filename, sheets_id, spreadsheet_range, page_size):
+    """The rows of a snapshot saved by write_sheet_snapshot, page by page"""
+    file = gzip.open(filename, "rt", encoding = "utf-8")
+    header = json.loads(file.readline())
+    if header['sheets_id'] != sheets_id or header['range'] != spreadsheet_range:
+        logger.warning("The snapshot %s is of %s in sheet %s, not %s in %s",
+                filename, header['range'], header['sheets_id'], spreadsheet_range, sheets_id)
+    logger.info("Using the snapshot %s of the sheet, fetched %s", filename, header['fetched'])
+
+    def pages():
+        with file:
+            page = []
+            for line in file:
+                page.append(json.loads(line))
+                if len(page) == page_size:
+                    yield page
+                    page = []
+            yield page
+
+    return pages()
+
+def print_request_metrics(metrics):
+    """Print the number of requests and their latencies per endpoint"""
+    histograms = [(dict(labels)['endpoint'], histogram) for (name, labels), histogram in sorted(metrics.histograms.items())
+            if name == "request_duration_seconds"]
+    if not histograms:
+        return
+    print("\nRequests per endpoint (latency upper bounds):")
+    for endpoint, histogram in histograms:
+        print("  %-28s %6d requests  p50 %6.0f ms  p99 %6.0f ms  max %6.0f ms  %5d retries  %8.1f KiB sent" % (
+            endpoint, histogram.count,
+            1000 * histogram.percentile(50), 1000 * histogram.percentile(99), 1000 * histogram.max,
+            metrics.total("retries_total", endpoint = endpoint),
+            metrics.total("request_bytes_total", endpoint = endpoint) / 1024.0))
+
+def create_uploader(parsed, server, session_token, use_async):
+    """Create the uploader matching the command line options"""
+    if use_fakes:
+        return AsyncFakeUploader() if use_async else FakeUploader() # quick testing
+
+    concurrency = None
+    if parsed.adaptive:
+        concurrency = AdaptiveConcurrency(parsed.max_in_flight if use_async else 2*parsed.workers)
+    rate_limiter = RateLimiter(parsed.max_rps) if parsed.max_rps else None
+
+    if use_async:
+        return AsyncUploader(
+                server, session_token,
+                max_in_flight = parsed.max_in_flight,
+                keep_alive = not parsed.no_keep_alive,
+                timeout = (parsed.connect_timeout, parsed.read_timeout),
+                retry_policy = RetryPolicy(parsed.retries, parsed.backoff_factor),
+                concurrency = concurrency,
+                rate_limiter = rate_limiter)
+    else:
+        return RealUploader(
+                server, session_token,
+                pool_size = parsed.pool_size or max(10, 2*parsed.workers),
+                keep_alive = not parsed.no_keep_alive,
+                timeout = (parsed.connect_timeout, parsed.read_timeout),
+                retry_policy = RetryPolicy(parsed.retries, parsed.backoff_factor),
+                concurrency = concurrency,
+                rate_limiter = rate_limiter)
+
+def open_oplog(bookkeeping_id, backend = "journal", server = None):
+    """Open the bookkeeping data for a bookkeeping id
+
+    The journal is migrated from the old YAML format if needed. The first time
+    a bookkeeping id is used with the sqlite backend, its journal is imported.
+    """
+    if not os.path.isdir("data"):
+        os.mkdir("data")
+    oplog = Oplog("data/%s-log.jsonl"%bookkeeping_id)
+
+    yaml_filename = "data/%s-log.yml"%bookkeeping_id
+    if os.path.isfile(yaml_filename) and not os.path.isfile(oplog.filename):
+        migrate_yaml_oplog(yaml_filename, oplog)
+        oplog.close()
+
+    if backend == "sqlite":
+        journal = oplog
+        oplog = SqliteOplog("data/bookkeeping.sqlite", bookkeeping_id, server)
+        if oplog.is_empty() and os.path.isfile(journal.filename):
+            count = 0
+            for item in journal.records():
+                oplog.append(LoggedExercise.from_dict(item))
+                count += 1
+            oplog.sync()
+            logger.info("Imported %d entries from %s into %s", count, journal.filename, oplog.filename)
+
+    return oplog
+
+def migrate_yaml_oplog(yaml_filename, oplog):
+    """One-shot conversion of a YAML bookkeeping file to the journal format
+
+    The YAML file is kept, renamed to *.migrated
+    """
+    import yaml
 
-    with open(oplog_filename, "r") as file: 
-        previous_session = yaml.safe_load(file)
+    with open(yaml_filename, "r") as file:
+        previous_session = yaml.safe_load(file) or []
 
     for item in previous_session:
-        tmp = LoggedExercise(
-                item['exercise_id'], 
-                item['uuid'] if 'uuid' in item else '' , 
-                item['status'], 
-                item['cts'])
-        uploads[tmp.exercise_id] = tmp
+        oplog.append(LoggedExercise.from_dict(item))
+    oplog.sync()
+
+    os.rename(yaml_filename, yaml_filename + ".migrated")
+    logger.info("Migrated %d entries from %s to %s", len(previous_session), yaml_filename, oplog.filename)
+
+def create_upload_map(oplog, statuses = None):
+    """Map each exercise id to its latest logged result
+
+    Optionally only include exercises whose latest result has one of the given statuses
+    """
+    return oplog.upload_map(statuses)
+
+def print_failures(oplog):
+    failures = create_upload_map(oplog, [Status.FAILED, Status.SKIPPED, Status.PENDING])
+    for entry in failures.values():
+        print("%s\t%s\t%s\t%s" % (entry.exercise_id, entry.status, entry.cts, entry.reason or ''))
+    print("%d failed, skipped or interrupted exercises" % len(failures))
+
+def clean_up_orphans(oplog, uploader):
+    """Delete the exercises that were created, but never got their images
+
+    These are left by uploads that failed or were interrupted, and would
+    otherwise be finished by the next import. Their bookkeeping entries are
+    updated to no longer refer to the deleted exercises. Uploaded images are
+    kept, to be reused.
+    """
+    unfinished = create_upload_map(oplog, [Status.PENDING, Status.FAILED, Status.SKIPPED])
+    orphans = [entry for entry in unfinished.values() if entry.uuid and entry.step != Step.LINKED]
+    for entry in orphans:
+        if uploader.delete_exercise(entry.uuid):
+            logger.info("Deleted exercise %s (server id: %s)", entry.exercise_id, entry.uuid)
+        else:
+            logger.info("Exercise %s (server id: %s) was already deleted", entry.exercise_id, entry.uuid)
+        timestamp = datetime.datetime.utcnow()
+        step = Step.IMAGE if entry.image_uuids else None
+        add_result_to_oplog(LoggedExercise(entry.exercise_id, None, entry.status, timestamp,
+            entry.images, entry.image_uuids, entry.reason, step = step), oplog)
+    print("Deleted %d unfinished exercises" % len(orphans))
+
+def parse_exercises(rows, prioritized, oplog, spreadsheet_ids, only_ids = None, shard = None, priorities = None):
+    """Lazily turn the prioritized rows into exercises
+
+    Invalid rows are logged as skipped. The ids of all rows are collected in
+    spreadsheet_ids, for the summary. If only_ids is given, other rows are ignored.
+    With a shard, rows of other shards are left out altogether. If priorities
+    is given, the priority of each exercise is put in it, for schedule_by_priority.
+    """
+    not_prioritized = 0
+    for row in rows:
+        if shard and not in_shard(row[1], shard):
+            metrics.count("rows_ignored_total")
+            continue
+        spreadsheet_ids.append(row[1])
+        if int(row[0]) not in prioritized:
+            not_prioritized += 1
+            metrics.count("rows_ignored_total")
+            continue
+        if only_ids is not None and row[1] not in only_ids:
+            metrics.count("rows_ignored_total")
+            continue
+        if priorities is not None:
+            priorities[row[1]] = int(row[0])
+
+        try:
+            with metrics.time("stage_duration_seconds", stage = "from_row"):
+                exercise = Exercise.from_row(row[1:])
+            logger.debug(str(exercise))
+            yield exercise
+        except InvalidExerciseData as e:
+            logger.warning("Invalid exercise data: {0}".format(e))
+            result = LoggedExercise.from_failure(row[1], Status.SKIPPED, str(e))
+            count_result(result)
+            add_result_to_oplog(result, oplog)
+
+    if not spreadsheet_ids:
+        # not sys.exit, as this may run in the thread of one of several targets
+        raise EmptySheetException("No data found in spreadsheet.")
+
+    logger.info("Got %s exercise rows from Google Sheets", len(spreadsheet_ids))
+    logger.info("Skipped %d exercises that are not priority %s", not_prioritized, prioritized)
+
+def schedule_by_priority(exercises, priorities, prioritized, image_index):
+    """Order the exercises by their priority's place in prioritized, then by image bytes, largest first
+
+    Starting the biggest uploads first keeps the workers busy until the end,
+    instead of one big upload running on its own at the end of the run. All the
+    rows are read before the first exercise is uploaded.
+    """
+    def cost(exercise):
+        try:
+            return sum(image_size(image) for image in image_index.get_images(exercise.id))
+        except (NonConformingImagesException, OSError, KeyError):
+            return 0 # skipped right away when uploading
+
+    with metrics.time("stage_duration_seconds", stage = "schedule"):
+        scheduled = sorted(exercises, key = lambda exercise: (prioritized.index(priorities[exercise.id]), -cost(exercise)))
+    logger.info("Scheduled %d exercises by priority and image size", len(scheduled))
+    return scheduled
+
+def until_deadline(exercises, deadline):
+    """Pass on the exercises until deadline seconds into the run"""
+    for exercise in exercises:
+        if metrics.elapsed() >= deadline:
+            logger.warning("Reached the deadline of %s, not starting any more uploads. The rest are left for the next run",
+                    datetime.timedelta(seconds = int(deadline)))
+            return
+        yield exercise
+
+def count_rows(pages):
+    """Pass on the pages of the sheet, counting the rows for the progress line"""
+    for page in pages:
+        metrics.count("sheet_rows_total", len(page))
+        yield page
+    metrics.set("sheet_rows", metrics.total("sheet_rows_total"))
+
+def prefetch(iterable, size = 2):
+    """Iterate over iterable in a background thread, keeping up to size items ready"""
+    items = queue.Queue(maxsize = size)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+            items.put((done, None))
+        except BaseException as e:
+            items.put((done, e))
+
+    threading.Thread(target = produce, daemon = True).start()
+    while True:
+        item, error = items.get()
+        if item is done:
+            if error:
+                raise error
+            return
+        yield item
+
+def run_uploads(exercises, image_index, uploads, uploader, oplog, workers, sync = False, images_first = True, target = None):
+    """Upload the exercises using a pool of workers, logging the results in sheet order
+
+    With a target, the results are counted with it as label, see TargetRun.
+    """
+    image_executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def process(exercise):
+        with metrics.time("exercise_duration_seconds"):
+            return process_exercise(exercise, image_index, uploads, uploader, image_executor, sync, oplog, images_first)
+
+    # results come back in sheet order. Workers only write pending entries to the oplog
+    try:
+        for result in run_in_order(process, exercises, workers):
+            count_result(result, target)
+            if isinstance(result, LoggedExercise):
+                add_result_to_oplog(result, oplog)
+    finally:
+        if image_executor:
+            image_executor.shutdown()
+
+async def run_async_uploads(exercises, image_index, uploads, uploader, oplog, window, sync = False, images_first = True, target = None):
+    """Event loop version of run_uploads
+
+    The uploader limits the number of requests in flight, so the window
+    only bounds how many exercises are being worked on at the same time.
+    """
+    async def process(exercise):
+        with metrics.time("exercise_duration_seconds"):
+            return await process_exercise_async(exercise, image_index, uploads, uploader, sync, oplog, images_first)
+
+    async with uploader:
+        async for result in arun_in_order(process, exercises, window):
+            count_result(result, target)
+            if isinstance(result, LoggedExercise):
+                add_result_to_oplog(result, oplog)
+
+def count_result(result, target = None):
+    """Count a processed exercise by its status, for the progress line and metrics"""
+    labels = { 'target': target } if target else {}
+    if isinstance(result, FailedUpdate):
+        metrics.count("exercises_done_total", status = Status.FAILED, action = Action.UPDATE, **labels)
+    else:
+        metrics.count("exercises_done_total", status = result.status if result else "UNCHANGED", **labels)
+
+def run_in_order(func, items, workers):
+    """Apply func to each item using a pool of worker threads
 
-    return uploads
+    Results are yielded in the same order as the items, regardless of
+    which worker finishes first. At most 2*workers items are in flight
+    at any time, so memory use stays bounded for long item lists.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2*workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+async def arun_in_order(coroutine_func, items, window):
+    """Like run_in_order, but running coroutines as tasks on the event loop"""
+    pending = collections.deque()
+    for item in items:
+        pending.append(asyncio.ensure_future(coroutine_func(item)))
+        if len(pending) >= window:
+            yield await pending.popleft()
+    while pending:
+        yield await pending.popleft()
+
+class ServerIndex:
+    """The exercises on the server, to find the ones the bookkeeping data does not know about
+
+    Exercises are matched on their fingerprint (see Exercise.fingerprint) or,
+    failing that, on their name. Each server exercise is matched at most once,
+    so duplicate rows in the sheet do not end up linked to the same exercise.
+    """
+
+    def __init__(self):
+        self.by_fingerprint = collections.defaultdict(list)
+        self.by_name = collections.defaultdict(list)
+        self.size = 0
+
+    def add(self, item):
+        image_uuids = None
+        if item.get('photo_start_id'):
+            image_uuids = {'start': item['photo_start_id'], 'end': item.get('photo_end_id') or ''}
+        found = (item['id'], Exercise.fingerprint_of(item), image_uuids)
+        self.by_fingerprint[found[1]].append(found)
+        self.by_name[item.get('name')].append(found)
+        self.size += 1
+
+    def match(self, exercise):
+        """Returns the uuid, fingerprint and image uuids of the matching server exercise, or None"""
+        candidates = self.by_fingerprint.get(exercise.fingerprint()) or self.by_name.get(exercise.name)
+        if not candidates:
+            return None
+        found = candidates.pop(0)
+        for other in (self.by_fingerprint[found[1]], self.by_name[exercise.name]):
+            if found in other:
+                other.remove(found)
+        return found
+
+def fetch_server_index(uploader):
+    """Page through the exercises on the server. Returns None if they cannot be listed"""
+    index = ServerIndex()
+    try:
+        with metrics.time("stage_duration_seconds", stage = "fetch_server_index"):
+            for item in uploader.list_exercises():
+                index.add(item)
+    except (requests.exceptions.RequestException, InvalidRequestException, KeyError, ValueError) as e:
+        logger.warning("Could not list the exercises on the server, not reconciling: %r", e)
+        return None
+    logger.info("Found %d exercises on the server", index.size)
+    return index
+
+def reconcile(exercises, server_index, uploads, oplog):
+    """Link the exercises to matching exercises on the server, if the bookkeeping data has no upload for them
+
+    Matches are logged as uploaded, with the fingerprint of the server's data,
+    so they are skipped, or updated if the row differs and --sync is given.
+    A match without images, i.e. left by a crash between creating and linking
+    an exercise, is logged as an unfinished upload, which then gets its images.
+    server_index is a future of fetch_server_index, so the exercises can be
+    parsed while the server is paged through.
+    """
+    for exercise in exercises:
+        index = server_index.result()
+        previous = uploads.get(exercise.id)
+        if index and not (previous and (previous.uuid or previous.image_uuids)):
+            found = index.match(exercise)
+            if found:
+                uuid, fingerprint, image_uuids = found
+                logger.info("Exercise %s is already on the server (server id: %s)", exercise.id, uuid)
+                metrics.count("exercises_reconciled_total", match = "fingerprint" if fingerprint == exercise.fingerprint() else "name")
+                if image_uuids:
+                    result = LoggedExercise(exercise.id, uuid, Status.OK, datetime.datetime.utcnow(),
+                            image_uuids = image_uuids, fingerprint = fingerprint)
+                else:
+                    result = LoggedExercise(exercise.id, uuid, Status.PENDING, datetime.datetime.utcnow(), step = Step.CREATED)
+                uploads[exercise.id] = result
+                add_result_to_oplog(result, oplog)
+        yield exercise
+
+def decide_action(exercise, uploads, sync = False):
+    """What to do with an exercise, given the results of previous sessions
+
+    Returns Action.CREATE, Action.UPDATE or None if there is nothing to do
+    """
+    previous = uploads.get(exercise.id)
+    if not previous or previous.status != Status.OK:
+        return Action.CREATE
+
+    if sync and previous.fingerprint != exercise.fingerprint():
+        return Action.UPDATE
+
+    logger.debug("Already uploaded exercise '%s' (server id: %s). Skipping.", exercise.id, previous.uuid)
+    return None
+
+def process_exercise(exercise, image_index, uploads, uploader, image_executor = None, sync = False, oplog = None, images_first = True):
+    """Upload an exercise unless a previous session already did
+
+    With sync, exercises that were changed after being uploaded are updated.
+    Returns the result to add to the oplog, or None if there is nothing to log.
+    """
+    try:
+        action = decide_action(exercise, uploads, sync)
+        if action == Action.UPDATE:
+            return sync_exercise(exercise, uploads[exercise.id], image_index, uploader, image_executor)
+        if not action:
+            return None
+
+        images = image_index.get_images(exercise.id)
+        return upload_exercise(exercise, images, uploader, image_executor, oplog, uploads.get(exercise.id), images_first)
 
-def add_result_to_oplog(item, log_filename):
+    except NonConformingImagesException as exception:
+        logger.warning("Images do not conform to expectation: %s", exception)
+        return LoggedExercise.from_failure(exercise.id, Status.SKIPPED, str(exception), uploads.get(exercise.id))
+
+    except (requests.exceptions.RequestException, InvalidRequestException) as exception:
+        logger.warning("Upload failed: %s", exception)
+        return LoggedExercise.from_failure(exercise.id, Status.FAILED, str(exception), uploads.get(exercise.id))
+
+async def process_exercise_async(exercise, image_index, uploads, uploader, sync = False, oplog = None, images_first = True):
+    """Coroutine version of process_exercise"""
+    try:
+        action = decide_action(exercise, uploads, sync)
+        if action == Action.UPDATE:
+            return await sync_exercise_async(exercise, uploads[exercise.id], image_index, uploader)
+        if not action:
+            return None
+
+        images = image_index.get_images(exercise.id)
+        return await upload_exercise_async(exercise, images, uploader, oplog, uploads.get(exercise.id), images_first)
+
+    except NonConformingImagesException as exception:
+        logger.warning("Images do not conform to expectation: %s", exception)
+        return LoggedExercise.from_failure(exercise.id, Status.SKIPPED, str(exception), uploads.get(exercise.id))
+
+    except ASYNC_REQUEST_ERRORS as exception:
+        logger.warning("Upload failed: %s", exception)
+        return LoggedExercise.from_failure(exercise.id, Status.FAILED, str(exception) or repr(exception), uploads.get(exercise.id))
+
+def add_result_to_oplog(item, oplog):
     """Log the upload for bookkeeping
 
     Makes it possible to later continue
@@ -220,41 +1487,1034 @@ def add_result_to_oplog(item, log_filename):
     reading in the list of uploads.
     """
 
-    with open(log_filename, "a+") as file: 
-        file.write(item.to_yaml_list_item())
+    with metrics.time("stage_duration_seconds", stage = "add_result_to_oplog"):
+        oplog.append(item)
+
+class Histogram:
+    """Distribution of durations in seconds, in fixed buckets like a Prometheus histogram"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        # the last count is for durations above the largest bucket
+        self.counts = [0] * (len(Histogram.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(Histogram.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the given percentile"""
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(Histogram.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return min(bound, self.max)
+        return self.max
+
+    def cumulative(self):
+        """(upper bound, count of durations up to it) pairs, ending with +Inf"""
+        total = 0
+        for bound, count in zip(Histogram.BUCKETS + ("+Inf",), self.counts):
+            total += count
+            yield bound, total
+
+class Metrics:
+    """Counters, gauges and timing histograms for a run
+
+    Metrics have a name and optional labels, i.e.
+    metrics.count("requests_total", endpoint = "POST /api/1/images", status = 201).
+    Safe to use from worker threads and coroutines. At the end of a run they are
+    written as JSON and in the Prometheus text format, see write.
+    """
+
+    def __init__(self, prefix = "ptflow_importer"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.histograms = {}
 
-def upload_exercise(exercise, images, uploader):
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+
+    def count(self, name, value = 1, **labels):
+        key = Metrics.key(name, labels)
+        with self.lock:
+            self.counters[key] += value
+
+    def set(self, name, value, **labels):
+        key = Metrics.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = Metrics.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        """Observe the time spent in a with block, also when it raises"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def total(self, name, **labels):
+        """Sum of the counters with this name having (at least) the given labels"""
+        wanted = set(Metrics.key(name, labels)[1])
+        with self.lock:
+            return sum(value for (counter_name, counter_labels), value in self.counters.items()
+                    if counter_name == name and wanted.issubset(counter_labels))
+
+    def gauge(self, name, **labels):
+        with self.lock:
+            return self.gauges.get(Metrics.key(name, labels))
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                    'elapsed_seconds': round(self.elapsed(), 3),
+                    'counters': [
+                        { 'name': name, 'labels': dict(labels), 'value': value }
+                        for (name, labels), value in sorted(self.counters.items()) ],
+                    'gauges': [
+                        { 'name': name, 'labels': dict(labels), 'value': value }
+                        for (name, labels), value in sorted(self.gauges.items()) ],
+                    'histograms': [
+                        {
+                            'name': name,
+                            'labels': dict(labels),
+                            'count': histogram.count,
+                            'sum': round(histogram.sum, 6),
+                            'max': round(histogram.max, 6),
+                            'p50': histogram.percentile(50),
+                            'p90': histogram.percentile(90),
+                            'p99': histogram.percentile(99),
+                            'buckets': { str(bound): count for bound, count in histogram.cumulative() } }
+                        for (name, labels), histogram in sorted(self.histograms.items()) ] }
+
+    @staticmethod
+    def from_dict(data):
+        """The counters and gauges of to_dict, i.e. as written by another process"""
+        loaded = Metrics()
+        loaded.started -= data['elapsed_seconds']
+        for counter in data['counters']:
+            loaded.counters[Metrics.key(counter['name'], counter['labels'])] = counter['value']
+        for gauge in data['gauges']:
+            loaded.gauges[Metrics.key(gauge['name'], gauge['labels'])] = gauge['value']
+        return loaded
+
+    def to_prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        declared = set()
+
+        def declare(name, metric_type):
+            if name not in declared:
+                declared.add(name)
+                lines.append("# TYPE %s %s" % (name, metric_type))
+
+        def label_string(labels, extra = ()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = [(label, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for label, value in pairs]
+            return "{" + ",".join('%s="%s"' % pair for pair in escaped) + "}"
+
+        with self.lock:
+            lines.append("# TYPE %s_elapsed_seconds gauge" % self.prefix)
+            lines.append("%s_elapsed_seconds %.3f" % (self.prefix, self.elapsed()))
+            for (name, labels), value in sorted(self.counters.items()):
+                name = "%s_%s" % (self.prefix, name)
+                declare(name, "counter")
+                lines.append("%s%s %s" % (name, label_string(labels), value))
+            for (name, labels), value in sorted(self.gauges.items()):
+                name = "%s_%s" % (self.prefix, name)
+                declare(name, "gauge")
+                lines.append("%s%s %s" % (name, label_string(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                name = "%s_%s" % (self.prefix, name)
+                declare(name, "histogram")
+                for bound, count in histogram.cumulative():
+                    lines.append("%s_bucket%s %d" % (name, label_string(labels, [("le", str(bound))]), count))
+                lines.append("%s_sum%s %.6f" % (name, label_string(labels), histogram.sum))
+                lines.append("%s_count%s %d" % (name, label_string(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename_prefix):
+        """Write the metrics to <prefix>.json and <prefix>.prom"""
+        outputs = [
+                (filename_prefix + ".json", json.dumps(self.to_dict(), indent = 2) + "\n"),
+                (filename_prefix + ".prom", self.to_prometheus()) ]
+        for filename, contents in outputs:
+            # replace atomically, for collectors reading the file at any time
+            tmp_filename = filename + ".tmp"
+            with open(tmp_filename, "w") as file:
+                file.write(contents)
+            os.replace(tmp_filename, filename)
+        return [filename for filename, _ in outputs]
+
+# metrics for the current run, used throughout the importer
+metrics = Metrics()
+
+class ProgressReporter:
+    """Logs a progress line with the rate and estimated time left at a fixed interval
+
+    Progress is counted in sheet rows. The total is not known until the whole
+    sheet has been fetched; until then the number of rows fetched so far is
+    shown with a '+', and the estimate is a lower bound. If filename_prefix is
+    given, the metrics are written there too, for i.e. launch_shards to read.
+    With targets (see TargetRun), the rows and estimate are shown for each target.
+    """
 
-    logger.info("Uploading exercise %s", exercise.id)
+    def __init__(self, metrics, interval = 10.0, filename_prefix = None, targets = None):
+        self.metrics = metrics
+        self.interval = interval
+        self.filename_prefix = filename_prefix
+        self.targets = targets
+        self.stopped = threading.Event()
+        self.started = None
+
+    def start(self):
+        self.started = time.monotonic()
+        threading.Thread(target = self.run, daemon = True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            logger.info(self.line())
+            if self.filename_prefix:
+                self.metrics.write(self.filename_prefix)
+
+    def line(self):
+        done = self.metrics.total("exercises_done_total")
+        failed = self.metrics.total("exercises_done_total", status = Status.FAILED)
+        skipped = self.metrics.total("exercises_done_total", status = Status.SKIPPED)
+        elapsed = time.monotonic() - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        requests_rate = self.metrics.total("requests_total") / elapsed if elapsed > 0 else 0.0
+
+        if not self.targets:
+            rows_text, eta = self.rows_progress(done, elapsed)
+            return "Progress: %s, %d exercises done (%d failed, %d skipped), %.1f exercises/s, %.1f requests/s, ETA %s" % (
+                    rows_text, done, failed, skipped, rate, requests_rate, eta)
+
+        # invalid rows are counted once, without a target
+        done_by_target = [self.metrics.total("exercises_done_total", target = target) for target in self.targets]
+        shared = done - sum(done_by_target)
+        targets_text = "; ".join("%s: %s, ETA %s" % ((target,) + self.rows_progress(target_done + shared, elapsed))
+                for target, target_done in zip(self.targets, done_by_target))
+        return "Progress: %s; %d exercises done (%d failed, %d skipped), %.1f exercises/s, %.1f requests/s" % (
+                targets_text, done, failed, skipped, rate, requests_rate)
+
+    def rows_progress(self, done, elapsed):
+        """The rows done out of all rows, and the estimated time left, given the exercises done"""
+        rows_done = done + self.metrics.total("rows_ignored_total")
+        rows = self.metrics.gauge("sheet_rows")
+        if rows is None:
+            rows = self.metrics.total("sheet_rows_total")
+            rows_text, eta_text = "%d+" % rows, "at least "
+        else:
+            rows_text, eta_text = "%d" % rows, ""
+
+        rows_rate = rows_done / elapsed if elapsed > 0 else 0.0
+        if rows_rate > 0:
+            eta = eta_text + str(datetime.timedelta(seconds = int(max(0, rows - rows_done) / rows_rate)))
+        else:
+            eta = "unknown"
+        return "%d/%s rows" % (rows_done, rows_text), eta
+
+def request_endpoint(method, path):
+    """The method and path of a request with the trailing ids replaced, i.e. 'PUT /api/1/exercises/{id}'"""
+    parts = path.split("?")[0].split("/")
+    if len(parts) > 4:
+        parts[4:] = ["{id}"]
+    return method + " " + "/".join(parts)
+
+def request_size(kwargs):
+    """Approximate number of body bytes of a request, given the keyword arguments for the request"""
+    if kwargs.get('data') is not None:
+        return len(kwargs['data'])
+    if kwargs.get('json') is not None:
+        return len(json.dumps(kwargs['json']))
+    return 0
+
+class Oplog:
+    """Append-only journal of upload results, one JSON object per line
+
+    The file stays open for the whole run. Each entry is flushed to the OS when
+    appended, so it survives the process being killed, but fsync is batched:
+    every sync_every entries or sync_interval seconds, whichever comes first.
+    Later entries for an exercise supersede earlier ones.
+    """
+
+    def __init__(self, filename, sync_every = 50, sync_interval = 1.0):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def append(self, item):
+        line = json.dumps(item.to_dict(), separators = (',', ':')) + "\n"
+        with self.lock:
+            if not self.file:
+                self.file = self.open_for_append()
+            self.file.write(line)
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self._sync()
+
+    def open_for_append(self):
+        """Open the journal for appending, repairing a last line cut short by a crash
+
+        Otherwise the first new entry would be appended to that line, and be
+        ignored along with it when reading.
+        """
+        if os.path.isfile(self.filename):
+            with open(self.filename, "r+b") as file:
+                end = file.seek(0, os.SEEK_END)
+                start = end
+                # look back for the end of the last complete line
+                while start > 0:
+                    size = min(start, 64*1024)
+                    file.seek(start - size)
+                    newline = file.read(size).rfind(b"\n")
+                    if newline >= 0:
+                        start = start - size + newline + 1
+                        break
+                    start -= size
+                if start < end:
+                    file.seek(start)
+                    try:
+                        json.loads(file.read().decode("utf-8"))
+                        file.write(b"\n")
+                    except ValueError:
+                        logger.warning("Removing the incomplete last line of %s", self.filename)
+                        file.truncate(start)
+        return open(self.filename, "a")
+
+    def upload_map(self, statuses = None):
+        uploads = dict()
+
+        for item in self.records():
+            tmp = LoggedExercise.from_dict(item)
+            uploads[tmp.exercise_id] = tmp
+
+        if statuses:
+            uploads = {k:v for k,v in uploads.items() if v.status in statuses}
+        return uploads
+
+    def status_counts(self):
+        return collections.Counter(entry.status for entry in self.upload_map().values())
+
+    def exercise_ids(self):
+        return list(self.upload_map().keys())
+
+    def records(self):
+        """Stream the logged entries as dicts, oldest first"""
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, "r") as file:
+            for number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # most likely the last line, cut short by a crash
+                    logger.warning("Ignoring corrupt line %d in %s", number, self.filename)
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        if self.file and self.unsynced:
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self._sync()
+                self.file.close()
+                self.file = None
+
+    def compact(self):
+        """Rewrite the journal, keeping only the latest entry for each exercise"""
+        self.close()
+        uploads = self.upload_map()
+        before = sum(1 for _ in self.records())
+
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as file:
+            for item in uploads.values():
+                file.write(json.dumps(item.to_dict(), separators = (',', ':')) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, self.filename)
+        logger.info("Compacted %s from %d to %d entries", self.filename, before, len(uploads))
+
+class SqliteOplog:
+    """Bookkeeping in a SQLite database shared by all bookkeeping ids and servers
+
+    Has the same interface as Oplog. Every entry is kept in the history table,
+    while the latest entry for each exercise is kept in the indexed latest table,
+    making resuming and summaries simple queries. Entries are buffered and written
+    in one short transaction every sync_every entries or within sync_interval
+    seconds, so no write transaction is left open between appends, locking out
+    the other processes and targets using the same database.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS history (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            bookkeeping_id TEXT NOT NULL,
+            server TEXT,
+            exercise_id TEXT NOT NULL,
+            entry TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS history_exercise ON history (bookkeeping_id, exercise_id);
+
+        CREATE TABLE IF NOT EXISTS latest (
+            bookkeeping_id TEXT NOT NULL,
+            exercise_id TEXT NOT NULL,
+            server TEXT,
+            uuid TEXT,
+            status TEXT NOT NULL,
+            cts TEXT NOT NULL,
+            reason TEXT,
+            entry TEXT NOT NULL,
+            PRIMARY KEY (bookkeeping_id, exercise_id));
+        CREATE INDEX IF NOT EXISTS latest_status ON latest (bookkeeping_id, status);
+        CREATE INDEX IF NOT EXISTS latest_cts ON latest (cts);
+    """
+
+    def __init__(self, filename, bookkeeping_id, server = None, sync_every = 200, sync_interval = 1.0):
+        self.filename = filename
+        self.bookkeeping_id = bookkeeping_id
+        self.server = server
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.timer = None
+
+        self.connection = sqlite3.connect(filename, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SqliteOplog.SCHEMA)
+
+    def is_empty(self):
+        with self.lock:
+            self._sync()
+            row = self.connection.execute(
+                    "SELECT 1 FROM history WHERE bookkeeping_id = ? LIMIT 1", (self.bookkeeping_id,)).fetchone()
+        return row is None
+
+    def append(self, item):
+        entry = json.dumps(item.to_dict(), separators = (',', ':'))
+        with self.lock:
+            self.pending.append((item.exercise_id, item.uuid, item.status, item.cts, item.reason, entry))
+            if len(self.pending) >= self.sync_every:
+                self._sync()
+            elif not self.timer:
+                # written within sync_interval, even if no more entries follow
+                self.timer = threading.Timer(self.sync_interval, self.timed_sync)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def upload_map(self, statuses = None):
+        query = "SELECT entry FROM latest WHERE bookkeeping_id = ?"
+        params = [self.bookkeeping_id]
+        if statuses:
+            query += " AND status IN (%s)" % ", ".join("?"*len(statuses))
+            params.extend(statuses)
+
+        uploads = dict()
+        with self.lock:
+            self._sync()
+            for (entry,) in self.connection.execute(query + " ORDER BY rowid", params):
+                tmp = LoggedExercise.from_dict(json.loads(entry))
+                uploads[tmp.exercise_id] = tmp
+        return uploads
+
+    def status_counts(self):
+        with self.lock:
+            self._sync()
+            return dict(self.connection.execute(
+                    "SELECT status, COUNT(*) FROM latest WHERE bookkeeping_id = ? GROUP BY status",
+                    (self.bookkeeping_id,)))
+
+    def exercise_ids(self):
+        with self.lock:
+            self._sync()
+            return [row[0] for row in self.connection.execute(
+                    "SELECT exercise_id FROM latest WHERE bookkeeping_id = ?", (self.bookkeeping_id,))]
+
+    def records(self):
+        """Stream the logged entries as dicts, oldest first"""
+        with self.lock:
+            self._sync()
+            rows = self.connection.execute(
+                    "SELECT entry FROM history WHERE bookkeeping_id = ? ORDER BY seq", (self.bookkeeping_id,)).fetchall()
+        for (entry,) in rows:
+            yield json.loads(entry)
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def timed_sync(self):
+        try:
+            self.sync()
+        except sqlite3.Error as e:
+            # the entries stay pending, for the next append or sync
+            logger.warning("Could not write the bookkeeping entries to %s: %s", self.filename, e)
+
+    def _sync(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending:
+            # the write transaction lasts only as long as these statements
+            with self.connection:
+                self.connection.executemany(
+                        "INSERT INTO history (bookkeeping_id, server, exercise_id, entry) VALUES (?, ?, ?, ?)",
+                        [(self.bookkeeping_id, self.server, exercise_id, entry) for exercise_id, _, _, _, _, entry in self.pending])
+                self.connection.executemany(
+                        """INSERT INTO latest (bookkeeping_id, exercise_id, server, uuid, status, cts, reason, entry)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (bookkeeping_id, exercise_id) DO UPDATE SET
+                            server = excluded.server, uuid = excluded.uuid, status = excluded.status,
+                            cts = excluded.cts, reason = excluded.reason, entry = excluded.entry""",
+                        [(self.bookkeeping_id, exercise_id, self.server, uuid, status, cts, reason, entry)
+                            for exercise_id, uuid, status, cts, reason, entry in self.pending])
+            self.pending = []
+        self.connection.commit()
+
+    def close(self):
+        # stays usable after closing, like Oplog, as the summary is created afterwards
+        self.sync()
+
+    def compact(self):
+        """Drop the superseded entries from the history"""
+        with self.lock:
+            deleted = self.connection.execute(
+                    """DELETE FROM history WHERE bookkeeping_id = ? AND seq NOT IN
+                    (SELECT MAX(seq) FROM history WHERE bookkeeping_id = ? GROUP BY exercise_id)""",
+                    (self.bookkeeping_id, self.bookkeeping_id)).rowcount
+            self._sync()
+        logger.info("Compacted %s by removing %d superseded entries for %s", self.filename, deleted, self.bookkeeping_id)
+
+class SummarizedOplog:
+    """Keeps the latest status of each exercise up to date as results are appended to an oplog
+
+    The summary at the end of a run then needs no second pass over the
+    bookkeeping data. Everything else is done by the wrapped oplog.
+    """
+
+    def __init__(self, oplog, uploads):
+        self.oplog = oplog
+        self.statuses = {exercise_id: entry.status for exercise_id, entry in uploads.items()}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.oplog, name)
+
+    def append(self, item):
+        self.oplog.append(item)
+        with self.lock:
+            self.statuses[item.exercise_id] = item.status
+
+    def status_counts(self):
+        with self.lock:
+            return collections.Counter(self.statuses.values())
+
+    def exercise_ids(self):
+        with self.lock:
+            return list(self.statuses)
+
+def upload_exercise(exercise, images, uploader, image_executor = None, oplog = None, previous = None, images_first = True):
+    """Create an exercise with its images, journaling each step
+
+    Every step is logged in the oplog as a PENDING entry before going on, see
+    UploadProgress. An unfinished upload from a previous session continues from
+    its last completed step, reusing the exercise and images already on the server.
+
+    With images_first the images are uploaded before the exercise is created with
+    the image ids in a single call. Otherwise the exercise is created first and
+    updated with the image ids once they have been uploaded, for servers that need it.
+    """
+    progress = UploadProgress(exercise.id, images, previous, oplog)
     try:
-        exercise.uuid = uploader.upload_exercise(exercise)
-    except InvalidRequestException as e:
-        return LoggedExercise.from_failure(exercise.id, Status.FAILED, str(e))
-
-    logger.debug("Uploading %s images for exercise %s", len(images), exercise.id)
-    img_uuid_start = uploader.upload_image(images[0])
-    img_uuid_end = uploader.upload_image(images[1]) if len(images) > 1 else ''
-    image_uuids = { 
-            'start': img_uuid_start,
-            'end': img_uuid_end }
+        if progress.step == Step.LINKED:
+            logger.info("Exercise %s was uploaded in a previous session", exercise.id)
+        else:
+            if not images_first and not progress.uuid:
+                logger.info("Uploading exercise %s", exercise.id)
+                progress.completed(Step.CREATED, uuid = uploader.upload_exercise(exercise))
+
+            logger.debug("Uploading %s images for exercise %s", len(images), exercise.id)
+            exercise.set_image_uuids(upload_images(images, uploader, image_executor, progress.image_uuids, progress.image_uploaded))
+
+            if progress.uuid:
+                # the exercise was created without images, in this or a previous session
+                exercise.uuid = progress.uuid
+                uploader.update_exercise(exercise)
+            else:
+                logger.info("Uploading exercise %s", exercise.id)
+                exercise.uuid = uploader.upload_exercise(exercise)
+            progress.completed(Step.LINKED, uuid = exercise.uuid)
+
+    except (requests.exceptions.RequestException, InvalidRequestException) as e:
+        logger.warning("Upload failed: %s", e)
+        return progress.entry(Status.FAILED, str(e))
+
+    timestamp = datetime.datetime.utcnow()
+    return LoggedExercise(exercise.id, progress.uuid, Status.OK, timestamp, images, progress.image_uuids, fingerprint = exercise.fingerprint())
+
+class UploadProgress:
+    """The steps completed in uploading an exercise
+
+    Each step is journaled in the oplog as a PENDING entry as soon as it is
+    done, see Step, so a crash only loses the requests in flight. Starts from
+    the entry of a previous session that did not finish: images are reused if
+    they are the same files, the exercise is reused in any case.
+    """
+
+    def __init__(self, exercise_id, images, previous = None, oplog = None):
+        self.exercise_id = exercise_id
+        self.images = images
+        self.oplog = oplog
+        self.lock = threading.Lock()
+        self.uuid = None
+        self.image_uuids = {}
+        self.step = None
+
+        if previous and previous.status != Status.OK:
+            self.uuid = previous.uuid or None
+            if previous.images == images:
+                self.image_uuids = dict(previous.image_uuids or {})
+                self.step = previous.step
+            elif self.uuid:
+                # the exercise has to be linked to the new images
+                self.step = Step.CREATED
+        if self.step:
+            logger.info("Continuing the upload of exercise %s from a previous session (%s)", exercise_id, self.step)
+
+    def completed(self, step, uuid = None):
+        with self.lock:
+            self.step = step
+            self.uuid = uuid or self.uuid
+            self.journal()
+
+    def image_uploaded(self, key, image_id):
+        with self.lock:
+            self.image_uuids[key] = image_id
+            self.step = self.step or Step.IMAGE
+            self.journal()
+
+    def journal(self):
+        if self.oplog:
+            add_result_to_oplog(self.entry(Status.PENDING), self.oplog)
+
+    def entry(self, status, reason = None):
+        timestamp = datetime.datetime.utcnow()
+        return LoggedExercise(self.exercise_id, self.uuid, status, timestamp,
+                self.images, dict(self.image_uuids), reason, step = self.step)
+
+def upload_images(images, uploader, image_executor = None, image_uuids = None, on_uploaded = None):
+    """Upload the start and end image, except those already in image_uuids
+
+    on_uploaded(key, image_id) is called as soon as each image has been uploaded.
+    """
+    image_uuids = dict(image_uuids or {})
+    missing = [(key, image) for key, image in zip(['start', 'end'], images) if not image_uuids.get(key)]
+
+    def upload(key, image):
+        image_id = uploader.upload_image(image)
+        if on_uploaded:
+            on_uploaded(key, image_id)
+        return image_id
+
+    if image_executor and len(missing) > 1:
+        # upload the end image in the background while doing the start image
+        img_uuid_end_future = image_executor.submit(upload, *missing[1])
+        try:
+            image_uuids['start'] = upload(*missing[0])
+        finally:
+            # also when the start image failed, so the failure is logged with the end image if it got uploaded
+            img_uuid_end_future.exception()
+        image_uuids['end'] = img_uuid_end_future.result()
+    else:
+        for key, image in missing:
+            image_uuids[key] = upload(key, image)
+    image_uuids.setdefault('end', '')
     logger.debug("Got image uuids: %s"%str(image_uuids))
-    exercise.set_image_uuids(image_uuids)
+    return image_uuids
 
-    # update the now existing exercise using images and the embedded uuid
-    uploader.update_exercise(exercise)
+def sync_exercise(exercise, previous, image_index, uploader, image_executor = None):
+    """Update an uploaded exercise whose row in the sheet has changed
+
+    On failure the previous result is kept, so the next sync tries again,
+    and a FailedUpdate is returned, for the summary.
+    """
+    logger.info("Updating changed exercise %s", exercise.id)
+    exercise.uuid = previous.uuid
+    images = previous.images
+    image_uuids = previous.image_uuids
+    try:
+        if not image_uuids:
+            # nothing to link the exercise to, so upload the images again
+            images = image_index.get_images(exercise.id)
+            image_uuids = upload_images(images, uploader, image_executor)
+        exercise.set_image_uuids(image_uuids)
+        uploader.update_exercise(exercise)
+    except (requests.exceptions.RequestException, InvalidRequestException) as exception:
+        logger.warning("Updating exercise %s failed: %s", exercise.id, exception)
+        return FailedUpdate(exercise.id, str(exception))
+
+    timestamp = datetime.datetime.utcnow()
+    return LoggedExercise(exercise.id, exercise.uuid, Status.OK, timestamp, images, image_uuids, fingerprint = exercise.fingerprint())
+
+async def upload_exercise_async(exercise, images, uploader, oplog = None, previous = None, images_first = True):
+    """Coroutine version of upload_exercise, uploading both images concurrently"""
+    progress = UploadProgress(exercise.id, images, previous, oplog)
+    try:
+        if progress.step == Step.LINKED:
+            logger.info("Exercise %s was uploaded in a previous session", exercise.id)
+        else:
+            if not images_first and not progress.uuid:
+                logger.info("Uploading exercise %s", exercise.id)
+                progress.completed(Step.CREATED, uuid = await uploader.upload_exercise(exercise))
+
+            logger.debug("Uploading %s images for exercise %s", len(images), exercise.id)
+            exercise.set_image_uuids(await upload_images_async(images, uploader, progress.image_uuids, progress.image_uploaded))
+
+            if progress.uuid:
+                exercise.uuid = progress.uuid
+                await uploader.update_exercise(exercise)
+            else:
+                logger.info("Uploading exercise %s", exercise.id)
+                exercise.uuid = await uploader.upload_exercise(exercise)
+            progress.completed(Step.LINKED, uuid = exercise.uuid)
+
+    except ASYNC_REQUEST_ERRORS as e:
+        logger.warning("Upload failed: %s", str(e) or repr(e))
+        return progress.entry(Status.FAILED, str(e) or repr(e))
 
     timestamp = datetime.datetime.utcnow()
-    return LoggedExercise(exercise.id, exercise.uuid, Status.OK, timestamp, images, image_uuids)
+    return LoggedExercise(exercise.id, progress.uuid, Status.OK, timestamp, images, progress.image_uuids, fingerprint = exercise.fingerprint())
+
+async def upload_images_async(images, uploader, image_uuids = None, on_uploaded = None):
+    image_uuids = dict(image_uuids or {})
+    missing = [(key, image) for key, image in zip(['start', 'end'], images) if not image_uuids.get(key)]
+
+    async def upload(key, image):
+        image_id = await uploader.upload_image(image)
+        if on_uploaded:
+            on_uploaded(key, image_id)
+        return image_id
+
+    # both uploads finish before a failure is raised, so it is logged with the image that did get uploaded
+    uploaded = await asyncio.gather(*[upload(key, image) for key, image in missing], return_exceptions = True)
+    for result in uploaded:
+        if isinstance(result, BaseException):
+            raise result
+    image_uuids.update(zip([key for key, _ in missing], uploaded))
+    image_uuids.setdefault('end', '')
+    logger.debug("Got image uuids: %s"%str(image_uuids))
+    return image_uuids
+
+async def sync_exercise_async(exercise, previous, image_index, uploader):
+    """Coroutine version of sync_exercise"""
+    logger.info("Updating changed exercise %s", exercise.id)
+    exercise.uuid = previous.uuid
+    images = previous.images
+    image_uuids = previous.image_uuids
+    try:
+        if not image_uuids:
+            images = image_index.get_images(exercise.id)
+            image_uuids = await upload_images_async(images, uploader)
+        exercise.set_image_uuids(image_uuids)
+        await uploader.update_exercise(exercise)
+    except ASYNC_REQUEST_ERRORS as exception:
+        logger.warning("Updating exercise %s failed: %r", exercise.id, exception)
+        return FailedUpdate(exercise.id, str(exception) or repr(exception))
+
+    timestamp = datetime.datetime.utcnow()
+    return LoggedExercise(exercise.id, exercise.uuid, Status.OK, timestamp, images, image_uuids, fingerprint = exercise.fingerprint())
 
 def uuid_string():
     return str(uuid.uuid4())
 
+class RetryPolicy:
+    """Decides if and when a failed request should be retried
+
+    Idempotent requests are retried on timeouts, connection errors, 429 and 5xx.
+    Exercise and image creation (POST) are only retried when we know the server
+    did not act on the request: the connection was never established, or the
+    server explicitly refused it with 429 or 503.
+    """
+
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+    RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+    REFUSED_STATUSES = frozenset([429, 503])
+
+    def __init__(self, retries = 3, backoff_factor = 0.5, max_backoff = 30.0):
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+    def should_retry_status(self, method, status_code, attempt):
+        if attempt >= self.retries:
+            return False
+        if method in RetryPolicy.IDEMPOTENT_METHODS:
+            return status_code in RetryPolicy.RETRY_STATUSES
+        return status_code in RetryPolicy.REFUSED_STATUSES
+
+    def should_retry_error(self, method, attempt, connect_failed):
+        if attempt >= self.retries:
+            return False
+        return connect_failed or method in RetryPolicy.IDEMPOTENT_METHODS
+
+    def backoff(self, attempt, retry_after = None):
+        """Seconds to wait before retrying, using exponential backoff with full jitter
+
+        A Retry-After value from the server takes precedence over the computed delay.
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2**attempt))
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (delay in seconds or an HTTP date) into seconds"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def connect_failed(exception):
+    """True if the request never reached the server, making it safe to resend"""
+    if isinstance(exception, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(exception.args[0], 'reason', None) if exception.args else None
+    # NewConnectionError (i.e. connection refused) is a subclass of ConnectTimeoutError
+    return isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+class AdaptiveConcurrency:
+    """AIMD limit on the number of requests in flight, driven by the server's responses
+
+    While responses are quick and successful, and the limit is actually reached,
+    the limit grows by one per limit's worth of responses (additive increase).
+    It is cut when the server refuses requests (429/503), fails (5xx, timeouts,
+    connection errors) or the smoothed latency of an endpoint grows beyond
+    latency_factor times its baseline (multiplicative decrease). After a cut,
+    further cuts wait for the cooldown, as the responses still in flight were
+    sent under the old limit. A Retry-After from the server holds back all new
+    requests until it has passed. Every change of the limit is logged.
+
+    Use acquire from threads, or acquire_async from a single event loop, and
+    release once the request is done.
+    """
+
+    REFUSED_STATUSES = frozenset([429, 503])
+
+    def __init__(self, max_limit, initial_limit = None, min_limit = 1,
+            latency_factor = 2.0, refused_decrease = 0.5, latency_decrease = 0.8, cooldown = 1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit or max(min_limit, max_limit // 4))
+        self.latency_factor = latency_factor
+        self.refused_decrease = refused_decrease
+        self.latency_decrease = latency_decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        # per endpoint: [smoothed latency, baseline latency]
+        self.latencies = {}
+        self.condition = threading.Condition()
+        self.released = None # asyncio.Event for acquire_async
+        metrics.set("concurrency_limit", int(self.limit))
+        logger.info("Adaptive concurrency: starting with %d requests in flight, at most %d", int(self.limit), self.max_limit)
+
+    def _try_acquire(self):
+        """Take a slot and return 0, or return the seconds to wait (None to wait for a release)"""
+        with self.condition:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.in_flight >= int(self.limit):
+                return None
+            self.in_flight += 1
+            return 0
+
+    def _update(self, endpoint, latency, status, retry_after):
+        """Give back a slot and adjust the limit to the outcome of the request"""
+        with self.condition:
+            limited = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+            if latency is None:
+                # the request was abandoned, which says nothing about the server
+                return
+            if status is None or status >= 500 or status in AdaptiveConcurrency.REFUSED_STATUSES:
+                if retry_after and status in AdaptiveConcurrency.REFUSED_STATUSES:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                    logger.info("Adaptive concurrency: pausing new requests for %.2f seconds as asked by the server", retry_after)
+                reason = "status %s" % status if status else "no response"
+                self._decrease(self.refused_decrease, "%s from %s" % (reason, endpoint))
+            elif self._latency_grew(endpoint, latency):
+                self._decrease(self.latency_decrease, "latency of %s up from %.0f to %.0f ms" % (
+                    endpoint, 1000 * self.latencies[endpoint][1], 1000 * self.latencies[endpoint][0]))
+            elif limited and status < 400:
+                self._increase()
+
+    def _latency_grew(self, endpoint, latency):
+        smoothed = self.latencies.get(endpoint)
+        if smoothed is None:
+            smoothed = self.latencies[endpoint] = [latency, latency]
+        smoothed[0] += 0.1 * (latency - smoothed[0])
+        # the baseline follows lasting changes in latency, but slowly
+        smoothed[1] = min(smoothed[0], smoothed[1] + 0.001 * (smoothed[0] - smoothed[1]))
+        return smoothed[0] > self.latency_factor * smoothed[1]
+
+    def _increase(self):
+        previous = int(self.limit)
+        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        if int(self.limit) != previous:
+            self._log_change(previous, "increase", "healthy responses")
+
+    def _decrease(self, factor, reason):
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        previous = int(self.limit)
+        self.limit = max(self.min_limit, self.limit * factor)
+        self._log_change(previous, "decrease", reason)
+
+    def _log_change(self, previous, decision, reason):
+        metrics.count("concurrency_decisions_total", decision = decision)
+        metrics.set("concurrency_limit", int(self.limit))
+        # increases are frequent, and only of interest when tuning
+        log = logger.debug if decision == "increase" else logger.info
+        log("Adaptive concurrency: %s from %d to %d requests in flight (%s)", decision, previous, int(self.limit), reason)
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self._try_acquire()
+                if wait == 0:
+                    return
+                self.condition.wait(wait)
+
+    async def acquire_async(self):
+        if self.released is None:
+            self.released = asyncio.Event()
+        while True:
+            wait = self._try_acquire()
+            if wait == 0:
+                return
+            self.released.clear()
+            try:
+                await asyncio.wait_for(self.released.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, endpoint, latency, status = None, retry_after = None):
+        """Give back the slot taken by acquire
+
+        status is None if there was no response, latency is None if the request was abandoned.
+        """
+        self._update(endpoint, latency, status, retry_after)
+        if self.released:
+            self.released.set()
+
+class RateLimiter:
+    """Token bucket allowing at most rate requests per second, in bursts of up to one second's worth"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        """Take a token, possibly ahead of time, and return the seconds to wait for it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay:
+            metrics.observe("rate_limit_wait_seconds", delay)
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self._reserve()
+        if delay:
+            metrics.observe("rate_limit_wait_seconds", delay)
+            await asyncio.sleep(delay)
+
 class RealUploader:
 
-    def __init__(self, server, bearer_token):
+    def __init__(self, server, bearer_token, pool_size = 10, keep_alive = True, timeout = (3.05, 5.0), retry_policy = None,
+            concurrency = None, rate_limiter = None):
         logger.debug("Initialized uploader with bearer token {0}".format(bearer_token))
         self.server = server
         self.bearer_token = bearer_token
+        self.timeout = timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter
+
+        # a single pooled session lets us reuse TCP/TLS connections across requests.
+        # retries are done by _request, so the adapter itself should not retry
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size, max_retries = 0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(self.default_headers())
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
 
     def default_headers(self):
         return {
@@ -262,38 +2522,112 @@ class RealUploader:
                 'Accept': 'application/json'
                 }
 
-    def upload_image(self, image):
+    def _request(self, method, path, **kwargs):
+        """Send a request using the pooled session, retrying as allowed by the retry policy"""
+        url = self.server + path
+        endpoint = request_endpoint(method, path)
+        size = request_size(kwargs)
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            if self.concurrency:
+                self.concurrency.acquire()
+            metrics.count("request_bytes_total", size, endpoint = endpoint)
+            start = time.monotonic()
+            try:
+                with metrics.time("request_duration_seconds", endpoint = endpoint):
+                    r = self.session.request(method, url, timeout = self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if self.concurrency:
+                    self.concurrency.release(endpoint, time.monotonic() - start)
+                metrics.count("requests_total", endpoint = endpoint, status = "error")
+                if not self.retry_policy.should_retry_error(method, attempt, connect_failed(e)):
+                    raise
+                delay = self.retry_policy.backoff(attempt)
+                logger.debug("%s %s failed: %s. Retrying in %.2f seconds", method, path, e, delay)
+            except BaseException:
+                if self.concurrency:
+                    self.concurrency.release(endpoint, None)
+                raise
+            else:
+                retry_after = parse_retry_after(r.headers.get('Retry-After'))
+                if self.concurrency:
+                    self.concurrency.release(endpoint, time.monotonic() - start, r.status_code, retry_after)
+                metrics.count("requests_total", endpoint = endpoint, status = r.status_code)
+                if not self.retry_policy.should_retry_status(method, r.status_code, attempt):
+                    return r
+                delay = self.retry_policy.backoff(attempt, retry_after)
+                logger.debug("%s %s got status %s. Retrying in %.2f seconds", method, path, r.status_code, delay)
+
+            attempt += 1
+            metrics.count("retries_total", endpoint = endpoint)
+            time.sleep(delay)
+
+    def upload_image(self, image, data = None):
         """See ApiImageController
          --> { image:'21fd2176-f3b9-11ea-ae83-00155d1775a6' }
-        """
 
-             
+        Pass the image bytes as data if they have already been read.
+        """
 
-        url = self.server + "/api/1/images"
-        headers = self.default_headers()
-        headers['content-type'] = 'image/png'
+        headers = { 'content-type': 'image/png' }
 
         # This is not needed on latest development branch
         # See https://stackoverflow.com/questions/63843865/wrong-content-length-when-sending-a-file/63854311#63854311
         headers['Content-Disposition'] = 'form-data; name="not-used"; filename="also-ignored.jpg"'
 
-        logger.debug("Image filesize: {0}".format(os.stat(image).st_size))
+        # read the whole file, as a file object can only be sent once if we need to retry
+        if data is None:
+            data = read_file(image)
+        logger.debug("Image filesize: {0}".format(len(data)))
 
-        with open(image, 'rb') as imagefile:
-            # POST image
-            r = requests.post(url, headers=headers, data=imagefile, timeout = 5.0)
-            logger.debug("Request headers for /api/1/images: {0}".format(r.request.headers))
-            logger.debug("Response headers for /api/1/images: {0}".format(r.headers))
+        # POST image
+        r = self._request('POST', "/api/1/images", headers=headers, data=data)
+        logger.debug("Request headers for /api/1/images: {0}".format(r.request.headers))
+        logger.debug("Response headers for /api/1/images: {0}".format(r.headers))
 
         json_response = r.json()
-        if r.status_code is not 201:
+        if r.status_code != 201:
             logger.warning("Failed in uploading image: {0}".format(json_response))
             raise InvalidRequestException(str(json_response))
 
         return json_response['image']['id']
 
+    def image_exists(self, image_id):
+        r = self._request('GET', "/api/1/images/" + image_id)
+        if r.status_code == 404:
+            return False
+        if r.status_code != 200:
+            raise InvalidRequestException("Unexpected status %s when looking up image %s"%(r.status_code, image_id))
+        return True
+
+    def list_exercises(self, page_size = 500):
+        """Page through the exercises on the server
+
+        Expects GET /api/1/exercises?page=1&limit=N
+         --> { exercises: [{ id:'21fd2176-...', name:'Air Bike', ... }] }
+        with fewer than N exercises on the last page.
+        """
+        page = 1
+        while True:
+            r = self._request('GET', "/api/1/exercises", params = {'page': page, 'limit': page_size})
+            if r.status_code != 200:
+                raise InvalidRequestException("Unexpected status %s when listing exercises"%r.status_code)
+            exercises = r.json()['exercises']
+            yield from exercises
+            if len(exercises) < page_size:
+                return
+            page += 1
+
     def delete_exercise(self, exercise_uuid):
-        pass
+        """Delete an exercise. Returns False if the server does not have it"""
+        r = self._request('DELETE', "/api/1/exercises/" + exercise_uuid)
+        if r.status_code == 404:
+            return False
+        if r.status_code not in (200, 204):
+            raise InvalidRequestException("Unexpected status %s when deleting exercise %s"%(r.status_code, exercise_uuid))
+        return True
 
     def update_exercise(self, exercise):
         if not exercise.uuid:
@@ -303,28 +2637,25 @@ class RealUploader:
     def upload_exercise(self, exercise, update = False):
         """See docs for ApiExerciseController.createAction"""
 
-        headers = self.default_headers()
-        headers['Content-Type'] = 'application/json'
+        headers = { 'Content-Type': 'application/json' }
 
         if update:
-            r = requests.put(
-                    self.server + "/api/1/exercises/"+exercise.uuid, 
-                    json = exercise.__dict__,
-                    timeout = 5.0,
+            r = self._request(
+                    'PUT', "/api/1/exercises/"+exercise.uuid,
+                    json = exercise.to_payload(),
                     headers = headers )
             json_response = r.json()
-            if r.status_code is not 200:
+            if r.status_code != 200:
                 logger.warning("Failed in updating exercise: {0}".format(json_response))
                 raise InvalidRequestException(str(json_response))
         else:
-            r = requests.post(
-                    self.server + "/api/1/exercises", 
-                    json = exercise.__dict__,
-                    timeout = 5.0,
+            r = self._request(
+                    'POST', "/api/1/exercises",
+                    json = exercise.to_payload(),
                     headers = headers )
 
             json_response = r.json()
-            if r.status_code is not 201:
+            if r.status_code != 201:
                 logger.warning("Failed in creating exercise: {0}".format(json_response))
                 raise InvalidRequestException(str(json_response))
 
@@ -333,16 +2664,193 @@ class RealUploader:
 
         return json_response['exercise']['id']
 
+class AsyncUploader:
+    """Coroutine version of RealUploader, used with --async
+
+    Every request goes through one aiohttp session. A semaphore bounds the
+    number of requests in flight, however many exercises are being processed.
+    Use as an async context manager to open and close the session.
+    """
+
+    def __init__(self, server, bearer_token, max_in_flight = 100, keep_alive = True, timeout = (3.05, 5.0), retry_policy = None,
+            concurrency = None, rate_limiter = None):
+        logger.debug("Initialized async uploader with bearer token {0}".format(bearer_token))
+        self.server = server
+        self.bearer_token = bearer_token
+        self.max_in_flight = max_in_flight
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter
+        self.session = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit = self.max_in_flight, force_close = not self.keep_alive)
+        self.session = aiohttp.ClientSession(
+                connector = connector,
+                headers = self.default_headers(),
+                timeout = aiohttp.ClientTimeout(sock_connect = self.timeout[0], sock_read = self.timeout[1]))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def default_headers(self):
+        return {
+                'Authorization': 'Bearer ' + self.bearer_token,
+                'Accept': 'application/json'
+                }
+
+    async def _request(self, method, path, **kwargs):
+        """Send a request, retrying as allowed by the retry policy
+
+        Returns the response status code and the decoded json body
+        """
+        url = self.server + path
+        endpoint = request_endpoint(method, path)
+        size = request_size(kwargs)
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                await self.rate_limiter.acquire_async()
+            if self.concurrency:
+                await self.concurrency.acquire_async()
+            start = time.monotonic()
+            try:
+                async with self.semaphore:
+                    metrics.count("request_bytes_total", size, endpoint = endpoint)
+                    with metrics.time("request_duration_seconds", endpoint = endpoint):
+                        async with self.session.request(method, url, **kwargs) as r:
+                            status = r.status
+                            retry_after = parse_retry_after(r.headers.get('Retry-After'))
+                            json_response = await r.json(content_type = None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if self.concurrency:
+                    self.concurrency.release(endpoint, time.monotonic() - start)
+                metrics.count("requests_total", endpoint = endpoint, status = "error")
+                connect_failed = isinstance(e, aiohttp.ClientConnectorError)
+                if not self.retry_policy.should_retry_error(method, attempt, connect_failed):
+                    raise
+                delay = self.retry_policy.backoff(attempt)
+                logger.debug("%s %s failed: %r. Retrying in %.2f seconds", method, path, e, delay)
+            except BaseException:
+                if self.concurrency:
+                    self.concurrency.release(endpoint, None)
+                raise
+            else:
+                if self.concurrency:
+                    self.concurrency.release(endpoint, time.monotonic() - start, status, retry_after)
+                metrics.count("requests_total", endpoint = endpoint, status = status)
+                if not self.retry_policy.should_retry_status(method, status, attempt):
+                    return status, json_response
+                delay = self.retry_policy.backoff(attempt, retry_after)
+                logger.debug("%s %s got status %s. Retrying in %.2f seconds", method, path, status, delay)
+
+            attempt += 1
+            metrics.count("retries_total", endpoint = endpoint)
+            await asyncio.sleep(delay)
+
+    async def upload_image(self, image, data = None):
+        """See RealUploader.upload_image"""
+
+        headers = {
+                'content-type': 'image/png',
+                'Content-Disposition': 'form-data; name="not-used"; filename="also-ignored.jpg"' }
+
+        if data is None:
+            # do not block the event loop on slow (e.g. network mounted) disks
+            data = await asyncio.get_running_loop().run_in_executor(None, read_file, image)
+        logger.debug("Image filesize: {0}".format(len(data)))
+
+        status, json_response = await self._request('POST', "/api/1/images", headers=headers, data=data)
+        if status != 201:
+            logger.warning("Failed in uploading image: {0}".format(json_response))
+            raise InvalidRequestException(str(json_response))
+
+        return json_response['image']['id']
+
+    async def delete_exercise(self, exercise_uuid):
+        """See RealUploader.delete_exercise"""
+        status, _ = await self._request('DELETE', "/api/1/exercises/" + exercise_uuid)
+        if status == 404:
+            return False
+        if status not in (200, 204):
+            raise InvalidRequestException("Unexpected status %s when deleting exercise %s"%(status, exercise_uuid))
+        return True
+
+    async def update_exercise(self, exercise):
+        if not exercise.uuid:
+            raise InvalidExerciseData("Trying to update exercise without a pre-set uuid does not make sense")
+        await self.upload_exercise(exercise, update = True)
+
+    async def upload_exercise(self, exercise, update = False):
+        """See RealUploader.upload_exercise"""
+
+        if update:
+            status, json_response = await self._request(
+                    'PUT', "/api/1/exercises/"+exercise.uuid, json = exercise.to_payload())
+            if status != 200:
+                logger.warning("Failed in updating exercise: {0}".format(json_response))
+                raise InvalidRequestException(str(json_response))
+        else:
+            status, json_response = await self._request(
+                    'POST', "/api/1/exercises", json = exercise.to_payload())
+            if status != 201:
+                logger.warning("Failed in creating exercise: {0}".format(json_response))
+                raise InvalidRequestException(str(json_response))
+
+        logger.debug("Response body: {0}".format(json_response))
+
+        return json_response['exercise']['id']
+
+def image_size(path):
+    """Size in bytes of an image file, or an image in a zip file"""
+    if ARCHIVE_SEPARATOR in path:
+        archive_ref, _, member = path.rpartition(ARCHIVE_SEPARATOR)
+        return open_archive(archive_ref).getinfo(member).file_size
+    return os.path.getsize(path)
+
+def read_file(path):
+    """Read an image file, or an image in a zip file, see ZipImageIndex"""
+    if ARCHIVE_SEPARATOR in path:
+        archive_ref, _, member = path.rpartition(ARCHIVE_SEPARATOR)
+        return open_archive(archive_ref).read(member)
+    with open(path, 'rb') as file:
+        return file.read()
+
 class InvalidRequestException(Exception):
     pass
 
+# what a failed request looks like when using AsyncUploader
+ASYNC_REQUEST_ERRORS = (asyncio.TimeoutError, json.JSONDecodeError, InvalidRequestException)
+
+def import_aiohttp():
+    """Import aiohttp for --async. Returns False if it is not installed"""
+    global aiohttp, ASYNC_REQUEST_ERRORS
+    if aiohttp is None:
+        try:
+            import aiohttp
+        except ImportError:
+            return False
+        ASYNC_REQUEST_ERRORS += (aiohttp.ClientError,)
+    return True
+
+def is_installed(module_name):
+    return importlib.util.find_spec(module_name) is not None
+
 class FakeUploader:
 
-    def upload_image(self, image):
+    def upload_image(self, image, data = None):
         logger.debug("Fake image upload of " + image)
         time.sleep(1)
         return uuid_string()
 
+    def image_exists(self, image_id):
+        return True
+
 
     def upload_exercise(self, exercise):
         logger.debug("Fake exercise upload of " + exercise.id)
@@ -353,29 +2861,683 @@ class FakeUploader:
         self.upload_exercise(exercise)
 
     def delete_exercise(self, exercise_uuid):
+        logger.debug("Fake exercise deletion of " + exercise_uuid)
+        return True
+
+    def list_exercises(self, page_size = 500):
+        return []
+
+class AsyncFakeUploader:
+    """FakeUploader for --async, sleeping without blocking the event loop"""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
         pass
 
-def get_images(image_dir, exercise_id):
-    # All these image paths assume the image dir is the subdir ./PACK
-    glob_string = image_dir + exercise_id + "*.png"
-    single_file_glob_string = image_dir + "SINGLE-STEP/" + exercise_id + "*SINGLE-STEP.png"
-    image_list = glob.glob(glob_string)
-    single_file = glob.glob(single_file_glob_string)
+    async def upload_image(self, image, data = None):
+        logger.debug("Fake image upload of " + image)
+        await asyncio.sleep(1)
+        return uuid_string()
 
-    assert not (len(single_file) > 0 and len(image_list) > 0)
+    async def upload_exercise(self, exercise):
+        logger.debug("Fake exercise upload of " + exercise.id)
+        await asyncio.sleep(2)
+        return uuid_string()
 
-    if image_list:
-        image_list.sort()
+    async def update_exercise(self, exercise):
+        await self.upload_exercise(exercise)
 
-        if len(image_list) > 2:
-            raise TooManyImagesException("%s images found for %s. Require only two for start/end"%(len(image_list), exercise_id))
+    async def delete_exercise(self, exercise_uuid):
+        logger.debug("Fake exercise deletion of " + exercise_uuid)
+        return True
 
-        return image_list
-    elif single_file:
-        logger.debug("id=%s. Single image: %s" % (exercise_id, single_file[0]))
-        return single_file
-    else:
-        raise NoImagesException("No images found for id " + exercise_id) 
+class ImageUploadCache:
+    """Persistent map from image contents to the image ids on a server
+
+    Entries are keyed on the server url and the sha256 of the image bytes,
+    so the same image is only uploaded once to each server, whatever its file
+    name or bookkeeping id. Entries unused for more than max_age_days are
+    evicted on load, as are the least recently used ones above max_entries.
+    Saving merges in the entries other processes saved meanwhile, i.e. the
+    other shards of an import.
+    """
+
+    def __init__(self, filename, server, max_age_days = 90, max_entries = 100000):
+        self.filename = filename
+        self.server = server
+        self.max_age = max_age_days * 24 * 3600
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # { (server, digest): image_id } of the entries dropped by verify, so they are not merged in again
+        self.removed = {}
+
+        # { server: { digest: { 'id': image_id, 'size': bytes, 'used': epoch seconds } } }
+        self.servers = {}
+        if os.path.isfile(filename):
+            with open(filename, "r") as file:
+                self.servers = json.load(file)
+        self.entries = self.servers.setdefault(server, {})
+        self.evict()
+
+    def for_server(self, server):
+        """The cache of the images on another server, kept in the same file"""
+        if server == self.server:
+            return self
+        other = copy.copy(self)
+        other.server = server
+        other.entries = self.servers.setdefault(server, {})
+        other.evict()
+        return other
+
+    def get(self, digest):
+        with self.lock:
+            entry = self.entries.get(digest)
+            if not entry:
+                return None
+            entry['used'] = time.time()
+            return entry['id']
+
+    def put(self, digest, image_id, size):
+        with self.lock:
+            self.entries[digest] = { 'id': image_id, 'size': size, 'used': time.time() }
+
+    def evict(self):
+        oldest_allowed = time.time() - self.max_age
+        with self.lock:
+            for entries in self.servers.values():
+                for digest in [d for d, entry in entries.items() if entry['used'] < oldest_allowed]:
+                    del entries[digest]
+
+            if len(self.entries) > self.max_entries:
+                by_last_use = sorted(self.entries, key = lambda d: self.entries[d]['used'])
+                for digest in by_last_use[:len(self.entries) - self.max_entries]:
+                    del self.entries[digest]
+
+    def verify(self, uploader, workers = 1):
+        """Drop the entries whose image no longer exists on the server"""
+        digests = list(self.entries)
+        exists = run_in_order(lambda d: uploader.image_exists(self.entries[d]['id']), digests, workers)
+        missing = [digest for digest, found in zip(digests, exists) if not found]
+        with self.lock:
+            for digest in missing:
+                self.removed[(self.server, digest)] = self.entries.pop(digest)['id']
+        logger.info("Verified %d cached images. Removed %d that no longer exist on the server", len(digests), len(missing))
+
+    def save(self):
+        with self.lock, open(self.filename + ".lock", "w") as lock_file:
+            # other processes wait here, so none of them loses the entries of another
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.isfile(self.filename):
+                with open(self.filename, "r") as file:
+                    self.merge(json.load(file))
+
+            # the pid keeps shard processes from writing to the same file
+            tmp_filename = "%s.%d.tmp" % (self.filename, os.getpid())
+            with open(tmp_filename, "w") as file:
+                json.dump(self.servers, file)
+            os.replace(tmp_filename, self.filename)
+
+    def merge(self, servers):
+        """Add the entries saved by other processes, keeping the most recently used of each image"""
+        for server, entries in servers.items():
+            ours = self.servers.setdefault(server, {})
+            for digest, entry in entries.items():
+                if self.removed.get((server, digest)) == entry['id']:
+                    continue
+                if digest not in ours or ours[digest]['used'] < entry['used']:
+                    ours[digest] = entry
+
+class CachingUploader:
+    """Wraps an uploader to avoid uploading images the server already has
+
+    See ImageUploadCache
+    """
+
+    def __init__(self, uploader, image_cache):
+        self.uploader = uploader
+        self.image_cache = image_cache
+
+    def __getattr__(self, name):
+        return getattr(self.uploader, name)
+
+    def upload_image(self, image, data = None):
+        if data is None:
+            data = read_file(image)
+        digest = hashlib.sha256(data).hexdigest()
+
+        image_id = self.image_cache.get(digest)
+        if image_id:
+            logger.debug("Image %s already uploaded as %s", image, image_id)
+            return image_id
+
+        image_id = self.uploader.upload_image(image, data)
+        self.image_cache.put(digest, image_id, len(data))
+        return image_id
+
+class AsyncCachingUploader(CachingUploader):
+    """CachingUploader for use with --async"""
+
+    async def __aenter__(self):
+        await self.uploader.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.uploader.__aexit__(*exc_info)
+
+    async def upload_image(self, image, data = None):
+        if data is None:
+            data = await asyncio.get_running_loop().run_in_executor(None, read_file, image)
+        digest = hashlib.sha256(data).hexdigest()
+
+        image_id = self.image_cache.get(digest)
+        if image_id:
+            logger.debug("Image %s already uploaded as %s", image, image_id)
+            return image_id
+
+        image_id = await self.uploader.upload_image(image, data)
+        self.image_cache.put(digest, image_id, len(data))
+        return image_id
+
+# memory for the image files shared by the targets of an import, see ImageReadCache
+IMAGE_READ_CACHE_BYTES = 256*1024*1024
+
+# how many exercises the fastest target of an import may get ahead of the slowest, see Broadcast
+BROADCAST_MAX_LAG = 10000
+
+class ImageReadCache:
+    """Keeps the most recently read image files in memory, so each file is read once for all targets
+
+    The least recently used files are dropped above max_bytes. A file being
+    read is not read again at the same time; the other readers wait for it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.lock = threading.Lock()
+        self.files = collections.OrderedDict()
+        self.reading = {}
+
+    def read(self, path):
+        while True:
+            with self.lock:
+                data = self.files.get(path)
+                if data is not None:
+                    self.files.move_to_end(path)
+                    metrics.count("image_reads_total", source = "memory")
+                    return data
+                reading = self.reading.get(path)
+                if reading is None:
+                    reading = self.reading[path] = threading.Event()
+                    break
+            # if reading fails, the next reader tries again
+            reading.wait()
+
+        try:
+            data = read_file(path)
+            metrics.count("image_reads_total", source = "disk")
+            with self.lock:
+                self.files[path] = data
+                self.size += len(data)
+                while self.size > self.max_bytes and len(self.files) > 1:
+                    _, dropped = self.files.popitem(last = False)
+                    self.size -= len(dropped)
+            return data
+        finally:
+            with self.lock:
+                del self.reading[path]
+            reading.set()
+
+class SharedReadsUploader:
+    """Wraps an uploader to read the images through an ImageReadCache"""
+
+    def __init__(self, uploader, image_reads):
+        self.uploader = uploader
+        self.image_reads = image_reads
+
+    def __getattr__(self, name):
+        return getattr(self.uploader, name)
+
+    def upload_image(self, image, data = None):
+        if data is None:
+            data = self.image_reads.read(image)
+        return self.uploader.upload_image(image, data)
+
+class AsyncSharedReadsUploader(SharedReadsUploader):
+    """SharedReadsUploader for use with --async"""
+
+    async def __aenter__(self):
+        await self.uploader.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.uploader.__aexit__(*exc_info)
+
+    async def upload_image(self, image, data = None):
+        if data is None:
+            data = await asyncio.get_running_loop().run_in_executor(None, self.image_reads.read, image)
+        return await self.uploader.upload_image(image, data)
+
+def create_process_pool(workers = None):
+    # not forked from this process, whose other threads may hold locks the children would inherit
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("forkserver"))
+    return ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("spawn"))
+
+class ImagePreprocessor:
+    """Optimizes and/or downscales images in a pool of processes before uploading
+
+    The results are cached in cache_dir, keyed on the hash of the original image
+    and the settings, so each image is only processed once. Keeps count of the
+    image bytes before and after processing.
+    """
+
+    def __init__(self, executor, optimize = True, max_dimension = None, cache_dir = "data/preprocessed"):
+        self.executor = executor
+        self.optimize = optimize
+        self.max_dimension = max_dimension
+        self.settings = "optimize=%s,max_dimension=%s" % (optimize, max_dimension)
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.lock = threading.Lock()
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def cache_filename(self, data):
+        digest = hashlib.sha256(self.settings.encode("utf-8") + data).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".png")
+
+    def process(self, image, data = None):
+        if data is None:
+            data = read_file(image)
+
+        filename = self.cache_filename(data)
+        if os.path.isfile(filename):
+            processed = read_file(filename)
+        else:
+            processed = self.executor.submit(preprocess_png, data, self.optimize, self.max_dimension).result()
+            self.store(filename, processed)
+
+        self.count(image, len(data), len(processed))
+        return processed
+
+    async def process_async(self, image, data = None):
+        loop = asyncio.get_running_loop()
+        if data is None:
+            data = await loop.run_in_executor(None, read_file, image)
+
+        filename = self.cache_filename(data)
+        if os.path.isfile(filename):
+            processed = await loop.run_in_executor(None, read_file, filename)
+        else:
+            processed = await loop.run_in_executor(self.executor, preprocess_png, data, self.optimize, self.max_dimension)
+            self.store(filename, processed)
+
+        self.count(image, len(data), len(processed))
+        return processed
+
+    def store(self, filename, processed):
+        tmp_filename = "%s.%d.tmp" % (filename, threading.get_ident())
+        with open(tmp_filename, "wb") as file:
+            file.write(processed)
+        os.replace(tmp_filename, filename)
+
+    def count(self, image, before, after):
+        logger.debug("Preprocessed %s: %d -> %d bytes", image, before, after)
+        with self.lock:
+            self.bytes_before += before
+            self.bytes_after += after
+
+class PreprocessingUploader:
+    """Wraps an uploader to preprocess images before uploading them
+
+    See ImagePreprocessor
+    """
+
+    def __init__(self, uploader, preprocessor):
+        self.uploader = uploader
+        self.preprocessor = preprocessor
+
+    def __getattr__(self, name):
+        return getattr(self.uploader, name)
+
+    def upload_image(self, image, data = None):
+        return self.uploader.upload_image(image, self.preprocessor.process(image, data))
+
+class AsyncPreprocessingUploader(PreprocessingUploader):
+    """PreprocessingUploader for use with --async"""
+
+    async def __aenter__(self):
+        await self.uploader.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.uploader.__aexit__(*exc_info)
+
+    async def upload_image(self, image, data = None):
+        return await self.uploader.upload_image(image, await self.preprocessor.process_async(image, data))
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# chunks that do not affect how the image looks
+PNG_METADATA_CHUNKS = frozenset([b'tEXt', b'zTXt', b'iTXt', b'tIME'])
+
+def preprocess_png(data, optimize, max_dimension):
+    """Runs in a worker process, see ImagePreprocessor"""
+    if max_dimension:
+        data = downscale_png(data, max_dimension)
+    if optimize:
+        data = optimize_png(data)
+    return data
+
+def downscale_png(data, max_dimension):
+    from PIL import Image as PILImage
+
+    image = PILImage.open(io.BytesIO(data))
+    if max(image.size) <= max_dimension:
+        return data
+
+    image.thumbnail((max_dimension, max_dimension), PILImage.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format = "PNG", optimize = True)
+    return output.getvalue()
+
+def optimize_png(data):
+    """Losslessly shrink a PNG
+
+    The image data is recompressed at the highest zlib level into a single
+    IDAT chunk, and text and timestamp chunks are dropped. The original data
+    is returned if it is not a valid PNG, or if nothing was saved.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+
+    chunks = []
+    idat = []
+    position = len(PNG_SIGNATURE)
+    while position + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[position:position + 8])
+        body = data[position + 8:position + 8 + length]
+        position += 12 + length
+
+        if chunk_type == b'IDAT':
+            if not idat:
+                chunks.append((chunk_type, None)) # placeholder for the recompressed data
+            idat.append(body)
+        elif chunk_type not in PNG_METADATA_CHUNKS:
+            chunks.append((chunk_type, body))
+
+    try:
+        raw = zlib.decompress(b''.join(idat))
+    except zlib.error:
+        return data
+    compressed = zlib.compress(raw, 9)
+
+    output = [PNG_SIGNATURE]
+    for chunk_type, body in chunks:
+        if body is None:
+            body = compressed
+        output.append(struct.pack(">I", len(body)) + chunk_type + body + struct.pack(">I", zlib.crc32(chunk_type + body)))
+    optimized = b''.join(output)
+
+    return optimized if len(optimized) < len(data) else data
+
+class ImageIndex:
+    """Index of the file names in the image directory
+
+    The directory is scanned once, instead of globbing it for every exercise.
+    Lookups follow the same rules as the globs '{id}*.png' in the image dir
+    and 'SINGLE-STEP/{id}*SINGLE-STEP.png', using binary search on the
+    sorted file names. The index is cached in the data dir and reused
+    for as long as the modification times of the directories are unchanged.
+    """
+
+    SINGLE_STEP_DIR = "SINGLE-STEP"
+    SINGLE_STEP_SUFFIX = "SINGLE-STEP.png"
+
+    def __init__(self, image_dir, pack_names, single_step_names):
+        self.image_dir = image_dir
+        self.pack_names = sorted(pack_names)
+        self.single_step_names = sorted(single_step_names)
+
+    @staticmethod
+    def load(image_dir, cache_dir = "data", rescan = False):
+        """Get the index from the cache if still valid, otherwise scan the image dir
+
+        If image_dir is a zip file, its contents are indexed instead, see ZipImageIndex.
+        """
+        if os.path.isfile(image_dir) and zipfile.is_zipfile(image_dir):
+            return ZipImageIndex.scan(image_dir)
+
+        cache_key = hashlib.sha1(os.path.abspath(image_dir).encode("utf-8")).hexdigest()[:12]
+        cache_filename = os.path.join(cache_dir, "image-index-%s.json"%cache_key)
+        mtimes = ImageIndex.directory_mtimes(image_dir)
+
+        if not rescan and os.path.isfile(cache_filename):
+            with open(cache_filename, "r") as file:
+                cached = json.load(file)
+            if cached['mtimes'] == mtimes:
+                logger.debug("Using cached image index %s", cache_filename)
+                return ImageIndex(image_dir, cached['pack'], cached['single_step'])
+
+        index = ImageIndex.scan(image_dir)
+        # replace atomically, shard processes may be reading it
+        tmp_filename = "%s.%d.tmp" % (cache_filename, os.getpid())
+        with open(tmp_filename, "w") as file:
+            json.dump({
+                'mtimes': mtimes,
+                'pack': index.pack_names,
+                'single_step': index.single_step_names }, file)
+        os.replace(tmp_filename, cache_filename)
+        return index
+
+    @staticmethod
+    def scan(image_dir):
+        pack_names = list_png_files(image_dir)
+        single_step_names = list_png_files(image_dir + ImageIndex.SINGLE_STEP_DIR)
+        logger.info("Indexed %d images in %s", len(pack_names) + len(single_step_names), image_dir)
+        return ImageIndex(image_dir, pack_names, single_step_names)
+
+    @staticmethod
+    def directory_mtimes(image_dir):
+        mtimes = []
+        for directory in [image_dir, image_dir + ImageIndex.SINGLE_STEP_DIR]:
+            try:
+                mtimes.append(os.stat(directory).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return mtimes
+
+    def get_images(self, exercise_id):
+        with metrics.time("stage_duration_seconds", stage = "get_images"):
+            return self._get_images(exercise_id)
+
+    def _get_images(self, exercise_id):
+        image_list = [self.pack_path(name) for name in find_prefixed(self.pack_names, exercise_id)]
+        single_file = [self.single_step_path(name)
+                for name in find_prefixed(self.single_step_names, exercise_id)
+                if name.endswith(ImageIndex.SINGLE_STEP_SUFFIX)
+                and len(name) >= len(exercise_id) + len(ImageIndex.SINGLE_STEP_SUFFIX)]
+
+        assert not (len(single_file) > 0 and len(image_list) > 0)
+
+        if image_list:
+            if len(image_list) > 2:
+                raise TooManyImagesException("%s images found for %s. Require only two for start/end"%(len(image_list), exercise_id))
+
+            return image_list
+        elif single_file:
+            logger.debug("id=%s. Single image: %s" % (exercise_id, single_file[0]))
+            return single_file
+        else:
+            raise NoImagesException("No images found for id " + exercise_id) 
+
+    def pack_path(self, name):
+        return self.image_dir + name
+
+    def single_step_path(self, name):
+        return self.image_dir + ImageIndex.SINGLE_STEP_DIR + "/" + name
+
+class ZipImageIndex(ImageIndex):
+    """Index of the images in a zip file, like the Drive export of the exercises
+
+    Nested zip files (i.e. the STEPS-pack.zip in the export) are indexed too,
+    using their central directories; nothing is extracted. Images in a folder
+    named SINGLE-STEP are single step images, all others are pack images. The
+    '1101' before the first dash of a name is removed in memory, like the
+    rename in the README. The images are referred to as, i.e.
+    'export.zip!/STEPS-pack.zip!/PACK/00011101-squat.png', which read_file
+    reads straight from the archive.
+    """
+
+    def __init__(self, image_dir, pack_members, single_step_members):
+        ImageIndex.__init__(self, image_dir, pack_members, single_step_members)
+        # normalized name -> reference to the member in the archive
+        self.pack_members = pack_members
+        self.single_step_members = single_step_members
+
+    @staticmethod
+    def scan(zip_filename):
+        pack_members = {}
+        single_step_members = {}
+        archives = [zip_filename]
+        while archives:
+            archive_ref = archives.pop(0)
+            for info in open_archive(archive_ref).infolist():
+                parts = info.filename.split("/")
+                if info.is_dir() or any(part.startswith(".") or part == "__MACOSX" for part in parts):
+                    continue
+                ref = archive_ref + ARCHIVE_SEPARATOR + info.filename
+                if info.filename.lower().endswith(".zip"):
+                    archives.append(ref)
+                elif info.filename.endswith(".png"):
+                    single_step = len(parts) > 1 and parts[-2] == ImageIndex.SINGLE_STEP_DIR
+                    members = single_step_members if single_step else pack_members
+                    name = ZipImageIndex.normalize_name(parts[-1])
+                    if name in members:
+                        logger.warning("Ignoring %s, as %s has the same name", ref, members[name])
+                    else:
+                        members[name] = ref
+
+        logger.info("Indexed %d images in %s", len(pack_members) + len(single_step_members), zip_filename)
+        return ZipImageIndex(zip_filename, pack_members, single_step_members)
+
+    @staticmethod
+    def normalize_name(name):
+        """'00011101-squat.png' -> '0001-squat.png'"""
+        return re.sub(r"^(.+?)1101-", r"\1-", name)
+
+    def pack_path(self, name):
+        return self.pack_members[name]
+
+    def single_step_path(self, name):
+        return self.single_step_members[name]
+
+# separates the archives and the member in a reference to an image in a zip file
+ARCHIVE_SEPARATOR = "!/"
+
+open_archives = {}
+open_archives_lock = threading.RLock()
+
+def open_archive(archive_ref):
+    """The ZipFile for a zip file or a zip file inside one, i.e. 'export.zip!/STEPS-pack.zip'
+
+    Archives are opened once and kept open for the rest of the run.
+    """
+    with open_archives_lock:
+        archive = open_archives.get(archive_ref)
+        if archive is None:
+            archive = open_archives[archive_ref] = zipfile.ZipFile(open_archive_file(archive_ref))
+        return archive
+
+def open_archive_file(archive_ref):
+    """A new file object for the bytes of an archive
+
+    A nested archive that is stored uncompressed (as zip files usually are) is
+    read in place. A compressed one has to be copied to a temporary file first,
+    as a compressed member can not be read from random positions.
+    """
+    parent_ref, _, member = archive_ref.rpartition(ARCHIVE_SEPARATOR)
+    if not parent_ref:
+        return open(archive_ref, "rb")
+
+    info = open_archive(parent_ref).getinfo(member)
+    if info.compress_type == zipfile.ZIP_STORED:
+        parent_file = open_archive_file(parent_ref)
+        parent_file.seek(info.header_offset)
+        # skip the local file header, which has its own name and extra field lengths
+        name_length, extra_length = struct.unpack("<HH", parent_file.read(30)[26:30])
+        return ArchiveSlice(parent_file, info.header_offset + 30 + name_length + extra_length, info.file_size)
+
+    logger.info("%s is compressed, copying it to a temporary file", archive_ref)
+    copy = tempfile.TemporaryFile()
+    with open_archive(parent_ref).open(member) as source:
+        shutil.copyfileobj(source, copy, 1024*1024)
+    copy.seek(0)
+    return copy
+
+class ArchiveSlice(io.RawIOBase):
+    """Read only file object for size bytes of file, starting at offset"""
+
+    def __init__(self, file, offset, size):
+        self.file = file
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self.position
+        elif whence == io.SEEK_END:
+            position += self.size
+        self.position = max(0, position)
+        return self.position
+
+    def readinto(self, buffer):
+        length = max(0, min(len(buffer), self.size - self.position))
+        if not length:
+            return 0
+        self.file.seek(self.offset + self.position)
+        read = self.file.readinto(memoryview(buffer)[:length])
+        self.position += read
+        return read
+
+    def close(self):
+        self.file.close()
+        io.RawIOBase.close(self)
+
+def list_png_files(directory):
+    """Names of the visible .png files in a directory, or an empty list if it does not exist"""
+    try:
+        with os.scandir(directory) as entries:
+            return [entry.name for entry in entries
+                    if entry.name.endswith(".png") and not entry.name.startswith(".") and entry.is_file()]
+    except FileNotFoundError:
+        return []
+
+def find_prefixed(sorted_names, prefix):
+    """All names starting with prefix (and long enough to also end in '.png')"""
+    found = []
+    position = bisect.bisect_left(sorted_names, prefix)
+    while position < len(sorted_names) and sorted_names[position].startswith(prefix):
+        name = sorted_names[position]
+        if len(name) >= len(prefix) + len(".png"):
+            found.append(name)
+        position += 1
+    return found
 
 class NonConformingImagesException(Exception):
     pass
@@ -386,7 +3548,20 @@ class NoImagesException(NonConformingImagesException):
 class TooManyImagesException(NonConformingImagesException):
     pass
 
-def get_stubbed_rows(ignore1,ignore2):
+def get_stubbed_rows(ignore1,ignore2, count = None):
+    """Rows to use instead of the Google Sheet
+
+    If count is given, that many valid rows are generated, with ids
+    '0000', '0001' and so on, all having priority 1 or 2.
+    """
+    if count:
+        return [[str(1 + n%2), "%04d"%n, "Exercise %d"%n, "", "Description of exercise %d ..."%n,
+                 Exercise.TYPES[n%len(Exercise.TYPES)].capitalize(),
+                 Exercise.EQUIPMENT[n%len(Exercise.EQUIPMENT)].replace("_", " ").capitalize(),
+                 Exercise.FOCUSES[n%len(Exercise.FOCUSES)].capitalize(),
+                 Exercise.FOCUSES[(n+1)%len(Exercise.FOCUSES)].capitalize()]
+                for n in range(count)]
+
     return [
         # ["0000","","","", "name", "type", "subtype", "equipment", "Body Part", "focus_primary", "", "description", "", "", "", "", "tags"],
           ["0001","","","", "Air Bike", "Body Weight", "", "Body weight", "", "Waist", "", "Start flat on your back ...", "", "", "", "", "Obliques, Gluteus Maximus, Quadriceps, Rectus Abdominis"],
@@ -395,11 +3570,18 @@ def get_stubbed_rows(ignore1,ignore2):
           ["0005","","","", "Air Bike5", "Body Weight", "", "Body weight", "", "Waist", "", "Start flat on your back ...", "", "", "", "", "Obliques, Gluteus Maximus, Quadriceps, Rectus Abdominis"]
         ]
 
-def get_spreadsheet_values(sheets_id, spreadsheet_range):
-    """Get the Google spreadsheet with the exercises
+def get_stubbed_pages(sheets_id, spreadsheet_range, page_size, count = None):
+    """Paged version of get_stubbed_rows, see get_spreadsheet_pages"""
+    rows = get_stubbed_rows(sheets_id, spreadsheet_range, count)
+    for start in range(0, len(rows), page_size):
+        yield rows[start:start + page_size]
+
+def get_credentials():
+    """Get credentials for the Google Sheets API, letting the user log in if needed"""
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
+    from google.auth.exceptions import RefreshError
 
-    This gets us a list of lists - each list representing a row
-    """
     # If modifying these scopes, delete the file token.pickle.
     SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
@@ -426,49 +3608,135 @@ def get_spreadsheet_values(sheets_id, spreadsheet_range):
         with open("token.pickle", "wb") as token:
             pickle.dump(creds, token)
 
-    service = build("sheets", "v4", credentials=creds)
+    return creds
 
-    # Call the Sheets API
-    logger.debug("Calling sheets API")
-    sheet = service.spreadsheets()
-    result = sheet.values().get(spreadsheetId=sheets_id,
-                                range=spreadsheet_range).execute()
+DISCOVERY_URL = "https://sheets.googleapis.com/$discovery/rest?version=v4"
+DISCOVERY_CACHE_FILENAME = "data/sheets-v4-discovery.json"
+DISCOVERY_CACHE_MAX_AGE = 7*24*3600
 
-    #logger.warning("TODO:remove limit ")
-    return result.get("values", []) #[0:5]
+def get_sheets_service():
+    """The Sheets API client, built from a locally cached discovery document
 
-def create_summary(oplog_filename, rows):
-    upload_map = create_upload_map(oplog_filename)
+    The discovery document describes the API. Fetching it, as build does
+    by default, costs a request on every run; it is fetched once a week instead.
+    """
+    from googleapiclient.discovery import build_from_document
 
-    failed = 0
-    skipped = 0
-    for entry in upload_map.values():
-        if entry.status == Status.SKIPPED: skipped += 1
-        if entry.status == Status.FAILED : failed += 1
+    try:
+        fresh = time.time() - os.path.getmtime(DISCOVERY_CACHE_FILENAME) < DISCOVERY_CACHE_MAX_AGE
+    except OSError:
+        fresh = False
+    if not fresh:
+        try:
+            r = requests.get(DISCOVERY_URL, timeout = 10)
+            r.raise_for_status()
+            if not os.path.isdir("data"):
+                os.mkdir("data")
+            tmp_filename = "%s.%d.tmp" % (DISCOVERY_CACHE_FILENAME, os.getpid())
+            with open(tmp_filename, "w") as file:
+                file.write(r.text)
+            os.replace(tmp_filename, DISCOVERY_CACHE_FILENAME)
+        except (requests.exceptions.RequestException, OSError) as e:
+            if not os.path.isfile(DISCOVERY_CACHE_FILENAME):
+                from googleapiclient.discovery import build
+                logger.warning("Could not fetch the Sheets discovery document, using the default: %s", e)
+                return build("sheets", "v4", credentials = get_credentials())
+            logger.warning("Could not refresh the Sheets discovery document, using the cached one: %s", e)
+
+    with open(DISCOVERY_CACHE_FILENAME, "r") as file:
+        return build_from_document(file.read(), credentials = get_credentials())
+
+def get_spreadsheet_pages(sheets_id, spreadsheet_range, page_size, pages_per_request = 2):
+    """Get the rows of the Google spreadsheet, page by page
+
+    The range (i.e. 'ILLUSTRATIONS!B2:J') is split into row ranges of page_size
+    rows, fetched pages_per_request at a time using batchGet. Returns a generator
+    of lists of rows, ending at the first page that is not full. Logging in
+    happens right away, not when starting to iterate.
+    """
+    sheet_name, start_column, start_row, end_column = parse_range(spreadsheet_range)
+    service = get_sheets_service()
+
+    def pages():
+        row = start_row
+        while True:
+            ranges = []
+            for _ in range(pages_per_request):
+                ranges.append("%s!%s%d:%s%d" % (sheet_name, start_column, row, end_column, row + page_size - 1))
+                row += page_size
+
+            logger.debug("Calling sheets API for %s", ranges)
+            with metrics.time("stage_duration_seconds", stage = "fetch_sheet"):
+                result = service.spreadsheets().values().batchGet(
+                        spreadsheetId=sheets_id, ranges=ranges).execute()
+
+            for value_range in result.get("valueRanges", []):
+                page = value_range.get("values", [])
+                yield page
+                if len(page) < page_size:
+                    return
+
+    return pages()
+
+def parse_range(spreadsheet_range):
+    """Split an A1 range like 'ILLUSTRATIONS!B2:J' into (sheet, start column, start row, end column)"""
+    match = re.match(r"^(.+)!([A-Z]+)(\d*):([A-Z]+)\d*$", spreadsheet_range)
+    if not match:
+        raise ValueError("Unsupported range: " + spreadsheet_range)
+    sheet_name, start_column, start_row, end_column = match.groups()
+    return sheet_name, start_column, int(start_row or 1), end_column
+
+def create_summary(oplog, spreadsheet_ids):
+    status_counts = oplog.status_counts()
+    failed = status_counts.get(Status.FAILED, 0)
+    skipped = status_counts.get(Status.SKIPPED, 0)
+
+    upload_ids = oplog.exercise_ids()
+    sheet_ids = set(spreadsheet_ids)
+    difference_ids = [id for id in upload_ids if id not in sheet_ids]
+    difference_ids += sheet_ids.difference(upload_ids)
+    logger.debug("%d ids in the sheet, %d in the bookkeeping data, differing: %s", len(spreadsheet_ids), len(upload_ids), difference_ids)
+
+    return (len(upload_ids), failed, skipped, difference_ids)
 
-    spreadsheet_ids = [row[1] for row in rows]
-    upload_ids = upload_map.keys()
-    difference_ids = list( set(spreadsheet_ids).symmetric_difference(set(upload_ids)))
-    logger.debug(spreadsheet_ids)
-    logger.debug(upload_ids)
-    logger.debug(difference_ids)
+class LoggedExercise:
 
-    return (len(upload_map.keys()), failed, skipped, difference_ids)
+    # there is one of these for every exercise in the bookkeeping file
+    __slots__ = ("uuid", "exercise_id", "status", "images", "image_uuids", "reason", "fingerprint", "step", "cts")
 
-class LoggedExercise:
+    @staticmethod
+    def from_dict(item):
+        """Create an instance from an entry in the bookkeeping file"""
+        step = item.get('step')
+        return LoggedExercise(
+                item['exercise_id'],
+                item['uuid'] if 'uuid' in item else '',
+                sys.intern(item['status']),
+                item['cts'],
+                item.get('images'),
+                item.get('image_uuids'),
+                item.get('reason'),
+                item.get('fingerprint'),
+                sys.intern(step) if step else step)
 
     @staticmethod
-    def from_failure(id, status, reason):
+    def from_failure(id, status, reason, previous = None):
+        """A failed or skipped result, keeping track of what a previous session put on the server"""
         timestamp = datetime.datetime.utcnow()
+        if previous and (previous.uuid or previous.image_uuids):
+            step = Step.LINKED if previous.status == Status.OK else previous.step
+            return LoggedExercise(id, previous.uuid, status, timestamp, previous.images, previous.image_uuids, reason, step = step)
         return LoggedExercise(id, None, status, timestamp, reason = reason)
 
-    def __init__(self, exercise_id, uuid, status, timestamp, images = None, image_uuids = None, reason = None):
+    def __init__(self, exercise_id, uuid, status, timestamp, images = None, image_uuids = None, reason = None, fingerprint = None, step = None):
         self.uuid = uuid
         self.exercise_id = exercise_id
         self.status = status
         self.images = images
         self.image_uuids = image_uuids
         self.reason = reason # failure or skip reason
+        self.fingerprint = fingerprint # of the uploaded exercise data, see Exercise.fingerprint
+        self.step = step # last completed step of an unfinished upload, see Step
 
         self.cts = timestamp
         if type(timestamp) is not str:
@@ -476,48 +3744,66 @@ class LoggedExercise:
             # across readers. otherwise would get python specific
             self.cts = timestamp.isoformat()
 
-    def to_yaml_list_item(self):
-        """Creates a YAML string representation of the instance"""
+    def to_dict(self):
+        """Creates the bookkeeping file representation of the instance"""
 
         # remove fields with the value None
-        dictionary = {k:v for k,v in self.__dict__.items() if v}
-
-        # wrap the dictionary in a list to produce a single item
-        return yaml.dump([dictionary], default_flow_style=False)
+        values = ((k, getattr(self, k)) for k in LoggedExercise.__slots__)
+        return {k:v for k,v in values if v}
 
     def __repr__(self):
         args = (self.exercise_id, self.uuid, self.status, self.cts)
         return "LoggedExercise(%s, %s, %s, %s)"%args
 
+class FailedUpdate:
+    """The result of a sync whose update failed, see sync_exercise
+
+    Counted, but not logged for bookkeeping, which keeps the previous result.
+    """
+
+    __slots__ = ("exercise_id", "reason")
+
+    def __init__(self, exercise_id, reason):
+        self.exercise_id = exercise_id
+        self.reason = reason
+
 class Exercise:
     """Create an exercise representation from a row
     """
 
+    __slots__ = ("id", "uuid", "name", "description", "type", "equipment", "focus_prim", "focus_sec",
+            "notes", "video", "translates", "photo_start_id", "photo_end_id")
+
     TYPES = ["STRENGTH", "WEIGHT", "CARDIO", "MOBILITY", "CORE", "YOGA" ]
     FOCUSES = [ "ABS", "BACK", "BICEPS", "CHEST", "FOREARMS", "FULLBODY", "GLUTES", "LEGS", "SHOULDERS", "TRICEPS" ]
     EQUIPMENT = [ "ARM_SLINGERS", "BAND", "BARBELL", "BELT_SQUAT", "BENCH", "BIKE", "BODY_WEIGHT", "BOSU_BALL", "CABLE", "DUMBBELL", "ELLIPTICAL", "EZ_BARBELL", "HAMMER", "JUMP_ROPE", "KETTLEBELL", "LEVERAGE_MACHINE", "MEDICINE_BALL", "PARALLEL_BARS", "POWER_SLED", "PUSH_UP_HANDLES", "RESISTANCE_BAND", "RINGS", "ROLLER", "ROPE", "ROW_MACHINE", "SKI_ERG", "SLED_MACHINE", "SMITH_MACHINE", "STABILITY_BALL", "STAIR_STEPPER", "STATIONARY_BIKE", "SUSPENSION", "TIRE", "TRAP_BAR", "TREADMILL", "VERSA_CLIMBER", "WEIGHT", "OTHER", "NO_EQUIPMENT" ]
+    # for validate, which runs for every row
+    TYPE_SET = frozenset(TYPES)
+    FOCUS_SET = frozenset(FOCUSES)
+    EQUIPMENT_SET = frozenset(EQUIPMENT)
 
     @staticmethod
     def from_row(row):
         """Basically a factory method: spreadsheet row to instance"""
 
+        # the values are interned, so all the exercises share one string per value
         def convert_focus(focus):
             val = focus.upper()
             if (val == "FULL BODY"):
                 return "FULLBODY"
-            return val
+            return sys.intern(val)
             
 
         def convert_type(literal_type):
             typeMap = { 'Body Weight': 'WEIGHT' }
             if literal_type in typeMap:
                 return typeMap[literal_type]
-            return literal_type.upper()
+            return sys.intern(literal_type.upper())
 
         def convert_equipment(raw_equipment):
             converted = raw_equipment.upper().replace(" ", "_")
 
-            return converted
+            return sys.intern(converted)
 
 
         required_length = 8 # C2-J2
@@ -553,25 +3839,53 @@ class Exercise:
         self.notes = ''
         self.video = ''
         self.translates = []
+        self.photo_start_id = None
+        self.photo_end_id = None
 
         self.validate()
 
     def validate(self):
+        """Raise InvalidExerciseData listing everything that is wrong with the exercise"""
 
         php_file = 'src/PETE/BackendBundle/Entity/Exercise.php'
-        if self.type not in Exercise.TYPES:
-            raise InvalidExerciseData("'%s' not a valid type. Refer to %s"%(self.type, php_file))
-        if self.focus_prim and self.focus_prim not in Exercise.FOCUSES:
-            raise InvalidExerciseData("'%s' not a valid focus. Refer to %s. Valid: %s"%(self.focus_prim, php_file, ", ".join(Exercise.FOCUSES)))
-        if self.focus_sec and self.focus_sec not in Exercise.FOCUSES:
-            raise InvalidExerciseData("'%s' not a valid focus. Refer to %s. Valid: %s"%(self.focus_sec, php_file, ", ".join(Exercise.FOCUSES)))
-        if self.equipment not in Exercise.EQUIPMENT:
-            raise InvalidExerciseData("'%s' not a valid equipment. Refer to %s. Valid: %s"%(self.equipment, php_file, ", ".join(Exercise.EQUIPMENT)))
+        errors = []
+        if self.type not in Exercise.TYPE_SET:
+            errors.append("'%s' not a valid type. Refer to %s"%(self.type, php_file))
+        if self.focus_prim and self.focus_prim not in Exercise.FOCUS_SET:
+            errors.append("'%s' not a valid focus. Refer to %s. Valid: %s"%(self.focus_prim, php_file, ", ".join(Exercise.FOCUSES)))
+        if self.focus_sec and self.focus_sec not in Exercise.FOCUS_SET:
+            errors.append("'%s' not a valid focus. Refer to %s. Valid: %s"%(self.focus_sec, php_file, ", ".join(Exercise.FOCUSES)))
+        if self.equipment not in Exercise.EQUIPMENT_SET:
+            errors.append("'%s' not a valid equipment. Refer to %s. Valid: %s"%(self.equipment, php_file, ", ".join(Exercise.EQUIPMENT)))
+        if errors:
+            raise InvalidExerciseData("; ".join(errors))
+
+    FINGERPRINT_FIELDS = ["name", "description", "type", "equipment", "focus_prim", "focus_sec", "notes", "video", "translates"]
+
+    def fingerprint(self):
+        """Hash of the exercise data from the sheet, to detect changes since an upload"""
+        return Exercise.fingerprint_of({field: getattr(self, field) for field in Exercise.FINGERPRINT_FIELDS})
+
+    @staticmethod
+    def fingerprint_of(values):
+        """Fingerprint of exercise data, i.e. as listed by the server, where empty fields may be null or missing"""
+        data = {field: values.get(field) or ([] if field == "translates" else '') for field in Exercise.FINGERPRINT_FIELDS}
+        return hashlib.sha1(json.dumps(data, sort_keys = True).encode("utf-8")).hexdigest()
 
     def set_image_uuids(self, uuids):
         self.photo_start_id = uuids['start']
         self.photo_end_id = uuids['end']
 
+    PAYLOAD_FIELDS = ["id", "uuid", "name", "description", "type", "equipment", "focus_prim", "focus_sec", "notes", "video", "translates"]
+
+    def to_payload(self):
+        """The JSON body for creating or updating the exercise on the server"""
+        payload = {field: getattr(self, field) for field in Exercise.PAYLOAD_FIELDS}
+        if self.photo_start_id is not None:
+            payload['photo_start_id'] = self.photo_start_id
+            payload['photo_end_id'] = self.photo_end_id
+        return payload
+
     def __str__(self):
         args = (self.id, self.name, self.type, self.focus_prim)
         return "Exercise{id=%s, name=%s, type=%s, focus_prim=%s}"%args
@@ -579,10 +3893,25 @@ class Exercise:
 class InvalidExerciseData(Exception):
     pass
 
+class EmptySheetException(Exception):
+    pass
+
 class Status:
     OK = 'OK'
     SKIPPED = 'SKIPPED'
     FAILED = 'FAILED'
+    PENDING = 'PENDING' # upload in progress, see Step
+
+class Step:
+    """Steps of an exercise upload, journaled with the PENDING entries"""
+    IMAGE = 'IMAGE' # images uploaded, see image_uuids for which
+    CREATED = 'CREATED' # exercise created without images
+    LINKED = 'LINKED' # exercise created or updated with its images
+
+class Action:
+    CREATE = 'CREATE'
+    UPDATE = 'UPDATE'
+    SKIP = 'SKIP' # only in plans, see build_plan
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,61 @@
+import importlib.util
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+WORK_DIR = tempfile.mkdtemp(prefix="ptflow-tests-")
+os.environ.setdefault("PTFLOW_IMPORTER_LOG_FILE", os.path.join(WORK_DIR, "import.log"))
+
+spec = importlib.util.spec_from_file_location("exercise_importer",
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "exercise-importer.py"))
+importer = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(importer)
+
+def logged(exercise_id, status = importer.Status.OK):
+    return importer.LoggedExercise(exercise_id, "uuid-" + exercise_id, status, "2026-10-17T00:00:00")
+
+class TwoConnectionsTest(unittest.TestCase):
+    """Two oplogs on one database, like two targets or shards of an import"""
+
+    def setUp(self):
+        self.filename = os.path.join(tempfile.mkdtemp(dir = WORK_DIR), "bookkeeping.sqlite")
+        self.first = importer.SqliteOplog(self.filename, "first", sync_interval = 60)
+        self.second = importer.SqliteOplog(self.filename, "second", sync_interval = 60)
+        # fail right away instead of after the default 5 seconds
+        self.second.connection.execute("PRAGMA busy_timeout = 100")
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+
+    def test_append_does_not_lock_out_other_connections(self):
+        self.first.append(logged("1"))
+        self.second.append(logged("2"))
+        self.second.sync()
+
+        self.first.append(logged("3"))
+        self.second.append(logged("4"))
+        self.second.sync()
+        self.first.sync()
+
+        self.assertEqual(["1", "3"], sorted(self.first.exercise_ids()))
+        self.assertEqual(["2", "4"], sorted(self.second.exercise_ids()))
+
+    def test_pending_entries_are_written_within_the_sync_interval(self):
+        self.first.sync_interval = 0.1
+        self.first.append(logged("1", importer.Status.FAILED))
+
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            reader = sqlite3.connect(self.filename)
+            rows = reader.execute("SELECT exercise_id, status FROM latest").fetchall()
+            reader.close()
+            if rows:
+                break
+            time.sleep(0.05)
+        self.assertEqual([("1", importer.Status.FAILED)], rows)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import asyncio
+import importlib.util
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+WORK_DIR = tempfile.mkdtemp(prefix="ptflow-tests-")
+os.environ.setdefault("PTFLOW_IMPORTER_LOG_FILE", os.path.join(WORK_DIR, "import.log"))
+
+spec = importlib.util.spec_from_file_location("exercise_importer",
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "exercise-importer.py"))
+importer = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(importer)
+
+IMAGES = ["PACK/0001-exercise-a.png", "PACK/0001-exercise-b.png"]
+
+class ListOplog:
+
+    def __init__(self):
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def append(self, item):
+        with self.lock:
+            self.entries.append(item)
+
+class StartFailsUploader:
+    """Fails the start image right away, while the end image is still being uploaded"""
+
+    def upload_image(self, image):
+        if image == IMAGES[0]:
+            raise importer.InvalidRequestException("start image failed")
+        time.sleep(0.2)
+        return "end-id"
+
+class AsyncStartFailsUploader:
+
+    async def upload_image(self, image):
+        if image == IMAGES[0]:
+            raise importer.InvalidRequestException("start image failed")
+        await asyncio.sleep(0.2)
+        return "end-id"
+
+def exercise():
+    return importer.Exercise("0001", "Squat", "", "STRENGTH", "BARBELL", "LEGS", "")
+
+class FailedUploadTest(unittest.TestCase):
+    """A failed upload is logged with every image that made it to the server"""
+
+    def assert_logged_with_end_image(self, result, oplog):
+        self.assertEqual(importer.Status.FAILED, result.status)
+        self.assertEqual("end-id", result.image_uuids.get('end'))
+        # nothing journaled after the result, which would supersede it
+        entries = len(oplog.entries)
+        time.sleep(0.3)
+        self.assertEqual(entries, len(oplog.entries))
+
+    def test_upload_exercise(self):
+        oplog = ListOplog()
+        with ThreadPoolExecutor(max_workers = 2) as image_executor:
+            result = importer.upload_exercise(exercise(), IMAGES, StartFailsUploader(), image_executor, oplog)
+        self.assert_logged_with_end_image(result, oplog)
+
+    def test_upload_exercise_async(self):
+        oplog = ListOplog()
+        result = asyncio.run(importer.upload_exercise_async(exercise(), IMAGES, AsyncStartFailsUploader(), oplog))
+        self.assert_logged_with_end_image(result, oplog)
+
+if __name__ == "__main__":
+    unittest.main()